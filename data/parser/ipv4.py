@@ -1,22 +1,31 @@
 import re
-import ipaddress
+from .ipv4_batch import valid_ipv4_addresses
 
-def is_valid_ipv4_address(ip_addr):
-    try:
-        # This will return True for both public and private IPv4 addresses
-        return isinstance(ipaddress.ip_address(ip_addr), ipaddress.IPv4Address)
-    except ValueError:
-        return False
+PARSER_API_VERSION = 2
+# Every IPv4 address contains dots
+PREFILTER_LITERALS = ('.',)
+# Four octets of up to three digits and three dots
+MAX_MATCH_LENGTH = 15
 
-def parse(text):
-    ipv4_regex = r'(?<!\d)(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(?!\d)'
-    matches = []
+IPV4_PATTERN = r'(?<!\d)(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(?!\d)'
+IPV4_REGEX = re.compile(IPV4_PATTERN)
+
+
+def use_regex_engine(compile_pattern):
+    # Called by the parser workers when entities.yaml selects a regex engine for this entity type (re2 falls back,
+    # it has no lookarounds)
+    global IPV4_REGEX
+    IPV4_REGEX = compile_pattern(IPV4_PATTERN)
 
-    for match in re.finditer(ipv4_regex, text):
-        ip_addr = match.group()
-        if is_valid_ipv4_address(ip_addr):
+
+def parse_iter(chunk, base_offset=0):
+    # Validated all at once, see ipv4_batch.py
+    matches = list(IPV4_REGEX.finditer(chunk))
+    for match, is_accepted in zip(matches, valid_ipv4_addresses([match.group() for match in matches])):
+        if is_accepted:
             start_pos, end_pos = match.span()
-            matches.append((ip_addr, start_pos, end_pos))
+            yield (match.group(), base_offset + start_pos, base_offset + end_pos)
 
-    return matches
 
+def parse(text):
+    return list(parse_iter(text))
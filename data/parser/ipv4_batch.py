@@ -0,0 +1,83 @@
+# Validation and classification of many IPv4 address matches at once: the dotted quads are converted to 32-bit
+# integers with NumPy and classified by integer range tests, instead of creating an ipaddress object per match.
+# Results are the same as those of ipaddress.ip_address(text) and its is_private, is_reserved and is_loopback.
+
+import re
+import ipaddress
+import numpy as np
+
+DOTTED_QUADS_REGEX = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(?:,\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})*')
+# ipaddress rejects octets with leading zeros, as they are ambiguous (octal)
+LEADING_ZERO_REGEX = re.compile(r'(?<!\d)0\d')
+
+
+def network_ranges(networks):
+    # [(first address, last address)] as integers
+    return [(int(network.network_address), int(network.broadcast_address)) for network in networks]
+
+
+# Taken from ipaddress itself, so the classification follows the Python version in use
+_constants = ipaddress.IPv4Address._constants
+PRIVATE_RANGES = network_ranges(_constants._private_networks)
+PRIVATE_EXCEPTION_RANGES = network_ranges(getattr(_constants, '_private_networks_exceptions', []))
+RESERVED_RANGES = network_ranges([_constants._reserved_network])
+LOOPBACK_RANGES = network_ranges([_constants._loopback_network])
+
+
+def in_ranges(addresses, ranges):
+    mask = np.zeros(len(addresses), dtype=bool)
+    for first, last in ranges:
+        mask |= (addresses >= first) & (addresses <= last)
+    return mask
+
+
+def parse_ipv4_addresses(match_texts):
+    # Returns (addresses, valid): the addresses as uint32 and whether ipaddress would accept each text
+    count = len(match_texts)
+    if count == 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+    joined = ','.join(match_texts)
+    if not DOTTED_QUADS_REGEX.fullmatch(joined):
+        # Not all plain dotted quads, leave these to ipaddress
+        return parse_ipv4_addresses_individually(match_texts)
+
+    octets = np.fromstring(joined.replace(',', '.'), dtype=np.int64, sep='.').reshape(count, 4)
+    valid = (octets <= 255).all(axis=1)
+    leading_zero_positions = [match.start() for match in LEADING_ZERO_REGEX.finditer(joined)]
+    if leading_zero_positions:
+        text_starts = np.cumsum([0] + [len(text) + 1 for text in match_texts[:-1]])
+        valid[np.searchsorted(text_starts, leading_zero_positions, side='right') - 1] = False
+    addresses = (octets[:, 0] << 24 | octets[:, 1] << 16 | octets[:, 2] << 8 | octets[:, 3]) & 0xFFFFFFFF
+    return addresses.astype(np.uint32), valid
+
+
+def parse_ipv4_addresses_individually(match_texts):
+    addresses = np.zeros(len(match_texts), dtype=np.uint32)
+    valid = np.zeros(len(match_texts), dtype=bool)
+    for i, text in enumerate(match_texts):
+        try:
+            address = ipaddress.ip_address(text)
+        except ValueError:
+            continue
+        if isinstance(address, ipaddress.IPv4Address):
+            addresses[i] = int(address)
+            valid[i] = True
+    return addresses, valid
+
+
+def valid_ipv4_addresses(match_texts):
+    return parse_ipv4_addresses(match_texts)[1]
+
+
+def is_private(addresses):
+    return in_ranges(addresses, PRIVATE_RANGES) & ~in_ranges(addresses, PRIVATE_EXCEPTION_RANGES)
+
+
+def private_ipv4_addresses(match_texts):
+    addresses, valid = parse_ipv4_addresses(match_texts)
+    return valid & is_private(addresses)
+
+
+def public_ipv4_addresses(match_texts):
+    addresses, valid = parse_ipv4_addresses(match_texts)
+    return valid & ~is_private(addresses) & ~in_ranges(addresses, RESERVED_RANGES) & ~in_ranges(addresses, LOOPBACK_RANGES)
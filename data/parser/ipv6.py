@@ -1,20 +1,70 @@
 import re
 import ipaddress
 
-def is_valid_ipv6_address(ip_addr):
+PARSER_API_VERSION = 2
+# Every IPv6 address contains colons
+PREFILTER_LITERALS = (':',)
+# Unbounded: addresses may carry a zone id of any length
+MAX_MATCH_LENGTH = None
+
+# Candidates are whole runs of hex digits, colons and dots containing at least two colons, plus an optional zone id.
+# A candidate can only start where a run starts and the quantifiers never give characters back, so every character
+# is looked at a bounded number of times, however long the hex runs (hashes, GUIDs, hex dumps) are.
+CANDIDATE_PATTERN = r'(?<![0-9A-Fa-f:.])[0-9A-Fa-f.]*+:[0-9A-Fa-f.]*+:[0-9A-Fa-f:.]*+(?:%[0-9A-Za-z]++)?'
+CANDIDATE_REGEX = re.compile(CANDIDATE_PATTERN)
+# Letters (other than hex digits) and underscores next to a candidate make it part of an identifier
+IDENTIFIER_CHARS = frozenset('GHIJKLMNOPQRSTUVWXYZghijklmnopqrstuvwxyz_')
+
+
+def use_regex_engine(compile_pattern):
+    # Called by the parser workers when entities.yaml selects a regex engine for this entity type. The candidate
+    # pattern needs a lookbehind and possessive quantifiers, re2 falls back to regex for it.
+    global CANDIDATE_REGEX
+    CANDIDATE_REGEX = compile_pattern(CANDIDATE_PATTERN)
+
+
+def trim_candidate(candidate):
+    # Returns (leading characters removed, address) without a single separating colon at either end
+    # ('ip:2001:db8::1', '::1:') and without trailing dots (end of a sentence)
+    start = 0
+    if candidate.startswith(':') and not candidate.startswith('::'):
+        start = 1
+    address = candidate[start:].rstrip('.')
+    if address.endswith(':') and not address.endswith('::'):
+        address = address[:-1]
+    return start, address
+
+
+def is_valid_ipv6_address(candidate):
+    address = candidate.split('%', 1)[0]
+    colons = address.count(':')
+    # Cheap shape test first: without '::' all eight groups (or six and an IPv4 address) have to be present.
+    # This rejects timestamps and MAC addresses without calling ipaddress.
+    if '::' in address:
+        if colons > 7:
+            return False
+    elif colons != (6 if '.' in address else 7):
+        return False
     try:
-        return isinstance(ipaddress.ip_address(ip_addr), ipaddress.IPv6Address)
+        ipaddress.IPv6Address(candidate)
+        return True
     except ValueError:
         return False
 
-def parse(text):
-    ipv6_regex = r'(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))'
-    matches = []
 
-    for match in re.finditer(ipv6_regex, text, re.IGNORECASE):
-        ip_addr = match.group()
+def parse_iter(chunk, base_offset=0):
+    for match in CANDIDATE_REGEX.finditer(chunk):
+        start_pos, end_pos = match.span()
+        leading, ip_addr = trim_candidate(match.group())
+        if leading == 0 and start_pos > 0 and chunk[start_pos - 1] in IDENTIFIER_CHARS:
+            continue
+        if end_pos < len(chunk) and chunk[end_pos] in IDENTIFIER_CHARS:
+            continue
         if is_valid_ipv6_address(ip_addr):
-            start_pos, end_pos = match.span()
-            matches.append((ip_addr, start_pos, end_pos))
+            start_pos += leading
+            yield (ip_addr, base_offset + start_pos, base_offset + start_pos + len(ip_addr))
+
+
+def parse(text):
+    return list(parse_iter(text))
 
-    return matches
@@ -3,23 +3,56 @@ logging.basicConfig(level=logging.INFO)
 logging.getLogger('tldextract').setLevel(logging.CRITICAL) 
 
 import tldextract
+from functools import lru_cache
+from urllib.parse import urlsplit
 import re
 
-def parse(text):
-    # Regular expression for detecting potential URLs
-    url_regex = r'\b(?:https?|ftp):\/\/[^\s]+'
-    matches = []
+PARSER_API_VERSION = 2
+# Every URL contains the scheme separator
+PREFILTER_LITERALS = ('://',)
+# Unbounded: a URL runs up to the next whitespace
+MAX_MATCH_LENGTH = None
 
-    for url_match in re.finditer(url_regex, text):
-        full_url = url_match.group()
+# Regular expression for detecting potential URLs
+URL_PATTERN = r'\b(?:https?|ftp):\/\/[^\s]+'
+URL_REGEX = re.compile(URL_PATTERN)
 
-        # Use tldextract to validate the domain and suffix
-        extracted = tldextract.extract(full_url)
+# Uses the public suffix list snapshot bundled with tldextract: no download on first use and no disk cache
+TLD_EXTRACTOR = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+# Distinct hosts remembered per parser process; logs mostly repeat a small set of hosts
+HOST_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=HOST_CACHE_SIZE)
+def is_valid_host(host):
+    # Use tldextract to validate the domain and suffix
+    extracted = TLD_EXTRACTOR(host)
+    return bool(extracted.domain and extracted.suffix)
+
+
+def url_host(url):
+    # The host part of the URL, '' if it has none (or the brackets of an IPv6 host do not match)
+    try:
+        return urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
 
-        if extracted.domain and extracted.suffix:
-            start_pos, end_pos = url_match.span()
-            matches.append((full_url, start_pos, end_pos))
 
-    return matches
+def use_regex_engine(compile_pattern):
+    # Called by the parser workers when entities.yaml selects a regex engine for this entity type
+    global URL_REGEX
+    URL_REGEX = compile_pattern(URL_PATTERN)
 
 
+def parse_iter(chunk, base_offset=0):
+    for url_match in URL_REGEX.finditer(chunk):
+        full_url = url_match.group()
+
+        # tldextract only looks at the host part of the URL, so the result is cached by host
+        if is_valid_host(url_host(full_url)):
+            start_pos, end_pos = url_match.span()
+            yield (full_url, base_offset + start_pos, base_offset + end_pos)
+
+
+def parse(text):
+    return list(parse_iter(text))
@@ -1,22 +1,154 @@
 import re
 import os
+import logging
+
+# The words are compiled into one case-insensitive pattern built from a trie of the words, matched with word
+# boundaries on both sides. Where several words match at the same position, the longest one wins (with the flat
+# alternation used before, the word listed first in the file won).
+# Building the pattern of a large wordlist takes long, so the pattern is cached on disk next to the wordlist, and
+# compiled once in the processing thread (see prepare), whose compiled pattern forked parser workers inherit.
+
+PARSER_API_VERSION = 2
+# The longest possible match depends on the wordlist, so documents are always parsed as a whole
+MAX_MATCH_LENGTH = None
+
+WORDLIST_PATH = os.path.join(os.path.dirname(__file__), 'wordlist.txt')
+# Longer words are skipped: every branch point along a word nests one group deeper, which the regex compiler
+# handles recursively
+MAX_WORD_LENGTH = 256
+
+# Compiled wordlist pattern of this process, rebuilt when wordlist.txt changes: (file_key, pattern)
+_compiled_wordlist = (None, None)
+# Compiles the wordlist pattern, see use_regex_engine
+_compile_pattern = re.compile
+
+
+def use_regex_engine(compile_pattern):
+    # Called by the parser workers when entities.yaml selects a regex engine for this entity type
+    global _compile_pattern, _compiled_wordlist
+    _compile_pattern = compile_pattern
+    _compiled_wordlist = (None, None)
+
+
+def prepare():
+    # Called once in the processing thread before the parser workers start
+    compile_wordlist(WORDLIST_PATH)
+
 
 def load_wordlist(file_path):
+    words = []
     with open(file_path, 'r', encoding='utf-8') as file:
-        return [line.strip() for line in file]
+        for line in file:
+            word = line.strip()
+            if len(word) > MAX_WORD_LENGTH:
+                logging.warning(f"Skipping a word of {len(word)} characters in {file_path}, words may have at most {MAX_WORD_LENGTH}: {word[:40]}...")
+            elif word:
+                words.append(word)
+    return words
 
-def parse(text):
-    wordlist_path = os.path.join(os.path.dirname(__file__), 'wordlist.txt')
-    wordlist = load_wordlist(wordlist_path)
-
-    # Create a regex pattern that matches any word in the wordlist
-    pattern = r'\b(' + '|'.join(re.escape(word) for word in wordlist) + r')\b'
-    
-    matches = []
-    for match in re.finditer(pattern, text, re.IGNORECASE):
+
+def trie_key(char):
+    # Matching ignores case, so words differing only in case share their trie nodes
+    lower = char.lower()
+    return lower if len(lower) == 1 else char
+
+
+def build_trie(words):
+    # Nested dicts keyed by character, '' marks the end of a word
+    trie = {}
+    for word in words:
+        node = trie
+        for char in (word.lower() if word.isascii() else map(trie_key, word)):
+            node = node.setdefault(char, {})
+        node[''] = True
+    return trie
+
+
+def is_leaf(node):
+    return len(node) == 1 and '' in node
+
+
+def trie_to_pattern(trie):
+    # Words sharing a prefix share one alternative for it, so the regex engine never tries more than one branch per
+    # character instead of every word of the list. Where one word is the prefix of another, the longer one is
+    # tried first. The trie is walked with an explicit stack of the nodes still to expand and the pattern pieces
+    # between them, so the length of the words is not limited by the recursion limit.
+    pieces = []
+    stack = [trie]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            pieces.append(item)
+            continue
+        is_word_end = '' in item
+        chars = sorted(char for char in item if char)
+        if not chars:
+            continue
+        if len(chars) == 1 and not is_word_end:
+            pieces.append(re.escape(chars[0]))
+            stack.append(item[chars[0]])
+            continue
+        # Words ending after one more (unescaped) character are merged into a character class, tried last
+        single_chars = [char for char in chars if is_leaf(item[char]) and len(re.escape(char)) == 1]
+        if len(single_chars) < 2:
+            single_chars = []
+        sequence = ['(?:']
+        for char in chars:
+            if char not in single_chars:
+                if len(sequence) > 1:
+                    sequence.append('|')
+                sequence.extend((re.escape(char), item[char]))
+        if single_chars:
+            sequence.append(('|' if len(sequence) > 1 else '') + '[' + ''.join(single_chars) + ']')
+        sequence.append(')?' if is_word_end else ')')
+        stack.extend(reversed(sequence))
+    return ''.join(pieces)
+
+
+def cached_pattern_source(file_path, file_key):
+    # The pattern built from the wordlist, from the cache file next to it if that was built from the same version
+    cache_path = file_path + '.pattern'
+    cache_header = f"{file_key[1]} {file_key[2]}\n"
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            if cache_file.readline() == cache_header:
+                return cache_file.read()
+    except OSError:
+        pass
+
+    wordlist = load_wordlist(file_path)
+    pattern_source = r'\b' + trie_to_pattern(build_trie(wordlist)) + r'\b' if wordlist else ''
+    temporary_path = f"{cache_path}.{os.getpid()}"
+    try:
+        with open(temporary_path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(cache_header + pattern_source)
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not cache the wordlist pattern in {cache_path}: {e}")
+    return pattern_source
+
+
+def compile_wordlist(file_path):
+    global _compiled_wordlist
+    file_stat = os.stat(file_path)
+    file_key = (file_path, file_stat.st_mtime_ns, file_stat.st_size)
+    if _compiled_wordlist[0] != file_key:
+        pattern_source = cached_pattern_source(file_path, file_key)
+        pattern = _compile_pattern(pattern_source, flags=re.IGNORECASE) if pattern_source else None
+        _compiled_wordlist = (file_key, pattern)
+    return _compiled_wordlist[1]
+
+
+def parse_iter(chunk, base_offset=0):
+    pattern = compile_wordlist(WORDLIST_PATH)
+    if pattern is None:
+        return
+
+    for match in pattern.finditer(chunk):
         matched_word = match.group()
         start_pos, end_pos = match.span()
-        matches.append((matched_word, start_pos, end_pos))
+        yield (matched_word, base_offset + start_pos, base_offset + end_pos)
 
-    return matches
 
+def parse(text):
+    return list(parse_iter(text))
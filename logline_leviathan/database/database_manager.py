@@ -1,13 +1,33 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Text, DateTime
+from sqlalchemy import create_engine, event, inspect, Column, Integer, String, ForeignKey, Text, DateTime, Index
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from contextlib import contextmanager
 import logging
 
 
 
+def create_ingest_engine(db_path='sqlite:///entities.db'):
+    # Engine for the file processing: pysqlite's own transaction handling is switched off and SQLAlchemy emits BEGIN
+    # itself, otherwise SAVEPOINTs (used for the batched entity writes) do not work as documented with SQLite.
+    # NullPool releases the file when processing ends, so the database can be purged or replaced afterwards.
+    engine = create_engine(db_path, poolclass=NullPool)
+
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    return engine
+
+
 SessionFactory = sessionmaker(bind=create_engine('sqlite:///entities.db'))
+IngestSessionFactory = sessionmaker(bind=create_ingest_engine())
 
 Base = declarative_base()
 
@@ -19,6 +39,8 @@ class DistinctEntitiesTable(Base):
     regex_library = relationship("EntityTypesTable")  
     individual_entities = relationship("EntitiesTable", back_populates="entity")
 
+    __table_args__ = (Index('ix_distinct_entity_type', 'distinct_entity', 'entity_types_id', unique=True),) # allows INSERT OR IGNORE for batched writes
+
 class EntitiesTable(Base):
     __tablename__ = 'entities_table' 
     entities_id = Column(Integer, primary_key=True) # is the primary key of the entities_table
@@ -51,6 +73,15 @@ class FileMetadata(Base):
     file_path = Column(String) # is the path of the original input file
     file_mimetype = Column(String) # is the MIME type of the original input file
 
+class FileTypeCacheTable(Base):
+    __tablename__ = 'file_type_cache'
+    # The MIME type sniffed for a file, which is identified by its device, inode, size and modification time, so a file changed or replaced since is sniffed again
+    device = Column(Integer, primary_key=True)
+    inode = Column(Integer, primary_key=True)
+    size = Column(Integer, primary_key=True)
+    mtime_ns = Column(Integer, primary_key=True) # modification time in nanoseconds
+    file_mimetype = Column(String) # is the MIME type libmagic returned for the file
+
 class EntityTypesTable(Base):
     __tablename__ = 'entity_types_table'
     entity_type_id = Column(Integer, primary_key=True) # is the primary key of the entity_types_table
@@ -60,6 +91,7 @@ class EntityTypesTable(Base):
     gui_tooltip = Column(String) # the GUI tooltip
     gui_name = Column(String) # the GUI name which is more descriptive than entity_type
     parent_type = Column(String, default='root')  # hierarchical structure from yaml specs
+    regex_engine = Column(String) # optional regex engine for the regex pattern and the script parser: re (default), regex or re2
     
 
 
@@ -68,6 +100,25 @@ def create_database(db_path='sqlite:///entities.db'):
     logging.debug(f"Create Database Engine")
     Base.metadata.create_all(engine)
     logging.debug(f"Created all Metadata")
+    # create_all does not add columns to tables which already exist, so columns added later are added to older databases here
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            try:
+                with engine.begin() as connection:
+                    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}")
+            except SQLAlchemyError as e:
+                logging.warning(f"Could not add column {column.name} to {table.name}: {e}")
+    # create_all skips tables which already exist, so indexes added later are created for older databases here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except SQLAlchemyError as e:
+                logging.warning(f"Could not create index {index.name}: {e}")
     engine.dispose()
     logging.debug(f"Disposed Engine")
 
@@ -92,9 +143,9 @@ if __name__ == "__main__":
     create_database()
 
 @contextmanager
-def session_scope():
+def session_scope(session_factory=SessionFactory):
     """Provide a transactional scope around a series of operations."""
-    session = SessionFactory()
+    session = session_factory()
     try:
         yield session
         session.commit()
@@ -90,6 +90,8 @@ class DatabaseOperations:
                     else:
                         for key, value in entity_data.items():
                             setattr(db_entity, key, value)
+                        # Optional in the YAML file, a removed key resets it to the default engine
+                        db_entity.regex_engine = entity_data.get('regex_engine')
                 else:
                     new_entity = EntityTypesTable(**entity_data)
                     session.add(new_entity)
@@ -112,6 +114,8 @@ class DatabaseOperations:
         if db_entity:
             # Check for inconsistency in existing entity
             for key, value in yaml_entity.items():
+                if key == 'regex_engine':
+                    continue  # Only changes how the entity type is parsed, taken over from the YAML file without asking
                 if getattr(db_entity, key, None) != value and value is not None:
                     return True
 
@@ -164,6 +168,8 @@ class DatabaseOperations:
                         'regex_pattern': entity.regex_pattern,
                         'script_parser': entity.script_parser
                     }
+                    if entity.regex_engine:
+                        yaml_data[entity.entity_type]['regex_engine'] = entity.regex_engine
 
         with open('./data/entities.yaml', 'w') as file:
             yaml.dump(yaml_data, file)
@@ -280,7 +286,7 @@ class ResolveInconsistenciesDialog(QDialog):
             return "\n".join(f"{key}: {value}" for key, value in entity.items())
         else:
             # Database entity needs to be formatted
-            return "\n".join(f"{attr}: {getattr(entity, attr)}" for attr in ['entity_type', 'gui_name', 'gui_tooltip', 'parent_type', 'regex_pattern', 'script_parser'])
+            return "\n".join(f"{attr}: {getattr(entity, attr)}" for attr in ['entity_type', 'gui_name', 'gui_tooltip', 'parent_type', 'regex_pattern', 'script_parser', 'regex_engine'])
 
 
 
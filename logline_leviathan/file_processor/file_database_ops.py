@@ -1,10 +1,12 @@
 import logging
 import os
+from collections import OrderedDict
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from logline_leviathan.database.database_manager import FileMetadata, DistinctEntitiesTable, EntitiesTable, ContextTable
-from datetime import datetime
 
 
-def handle_file_metadata(db_session, file_path, file_mimetype, sheet_name=None):
+def handle_file_metadata(db_session, file_path, file_mimetype, sheet_name=None, commit=True):
     try:
         # Construct file name with or without sheet name
         base_file_name = os.path.basename(file_path)
@@ -20,7 +22,10 @@ def handle_file_metadata(db_session, file_path, file_mimetype, sheet_name=None):
             # Update the MIME type if the record already exists
             file_metadata.file_mimetype = file_mimetype
 
-        db_session.commit()
+        if commit:
+            db_session.commit()
+        else:
+            db_session.flush()  # Assigns the file_id
         return file_metadata
     except Exception as e:
         logging.error(f"Error handling file metadata for {file_path}: {e}")
@@ -28,84 +33,215 @@ def handle_file_metadata(db_session, file_path, file_mimetype, sheet_name=None):
 
 
 
-def handle_distinct_entity(db_session, match_text, entity_type_id):
-    try:
-        distinct_entity = db_session.query(DistinctEntitiesTable).filter_by(distinct_entity=match_text, entity_types_id=entity_type_id).first()
-        if not distinct_entity:
-            distinct_entity = DistinctEntitiesTable(distinct_entity=match_text, entity_types_id=entity_type_id)
-            db_session.add(distinct_entity)
-            db_session.commit()
-
-        return distinct_entity
-    except Exception as e:
-        logging.error(f"Error handling distinct entity {match_text}: {e}")
-        return None
-
-
-
-def handle_individual_entity(db_session, entity, file_metadata, line_number, timestamp, entity_types_id, abort_flag, thread_instance):
-    try:
-        if abort_flag():
+# Number of matches collected per file before they are written to the database together
+ENTITY_BATCH_SIZE = 5000
+# Keeps IN (...) lookups below SQLite's limit of bound parameters per statement
+SQLITE_MAX_IN_PARAMETERS = 500
+# Number of (distinct_entity, entity_types_id) -> distinct_entities_id mappings kept in memory during a run
+DISTINCT_ENTITY_CACHE_SIZE = 200000
+# Lines before and after the matched line(s) stored as context
+CONTEXT_SIZES = {
+    'Single-Line Context': 0,
+    'Medium Context': 8,
+    'Large Context': 15
+    #'Index Context': 30
+}
+MAX_CONTEXT_LINES = max(CONTEXT_SIZES.values())
+
+
+class DistinctEntityCache:
+    # LRU cache of distinct entity ids shared by all files of a processing run, so entities which show up again and
+    # again (the same IP in every line) are resolved without asking SQLite. Only committed ids are put here.
+
+    def __init__(self, max_size=DISTINCT_ENTITY_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def warm_start(self, db_session):
+        # The most recently added distinct entities are the most likely ones to show up again
+        rows = db_session.query(DistinctEntitiesTable.distinct_entity, DistinctEntitiesTable.entity_types_id, DistinctEntitiesTable.distinct_entities_id) \
+                         .order_by(DistinctEntitiesTable.distinct_entities_id.desc()) \
+                         .limit(self.max_size) \
+                         .all()
+        for distinct_entity, entity_types_id, distinct_entities_id in reversed(rows):
+            self.entries[(distinct_entity, entity_types_id)] = distinct_entities_id
+        logging.debug(f"Distinct entity cache warmed up with {len(rows)} entries")
+
+    def get(self, distinct_key):
+        distinct_entities_id = self.entries.get(distinct_key)
+        if distinct_entities_id is None:
+            self.misses += 1
             return None
-        if timestamp and isinstance(timestamp, str):
-            try:
-                timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                logging.warning(f"Invalid timestamp format: {timestamp}")
-                timestamp = None
-
-        individual_entity = db_session.query(EntitiesTable).filter_by(
-            distinct_entities_id=entity.distinct_entities_id, 
-            file_id=file_metadata.file_id, 
-            line_number=line_number
-        ).first()
-
-        if not individual_entity:
-            individual_entity = EntitiesTable(
-                distinct_entities_id=entity.distinct_entities_id,
-                file_id=file_metadata.file_id,
-                line_number=line_number,
-                entry_timestamp=timestamp,
-                entity_types_id=entity_types_id
-            )
-            db_session.add(individual_entity)
-            db_session.commit()
-
-            thread_instance.total_entities_count_lock.lock()  # Lock the mutex
-            try:
-                thread_instance.total_entities_count += 1
-            finally:
-                thread_instance.total_entities_count_lock.unlock()  # Unlock the mutex
-
-            thread_instance.calculate_and_emit_rate()
-
-        return individual_entity
-    except Exception as e:
-        logging.error(f"Error handling individual entity in {file_metadata.file_path}, line {line_number}: {e}")
-        return None
+        self.entries.move_to_end(distinct_key)
+        self.hits += 1
+        return distinct_entities_id
+
+    def put(self, distinct_key, distinct_entities_id):
+        self.entries[distinct_key] = distinct_entities_id
+        self.entries.move_to_end(distinct_key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class EntityBatchWriter:
+    # Collects the matches of one file (or sheet) and writes distinct entities, entities and context in batches.
+    # Every batch is written inside a savepoint, the file's transaction is committed by finish(), so an abort or
+    # an error never leaves entities without their context or distinct entity behind.
+
+    def __init__(self, db_session, file_metadata, thread_instance, batch_size=ENTITY_BATCH_SIZE):
+        self.db_session = db_session
+        self.file_metadata = file_metadata
+        self.thread_instance = thread_instance
+        self.batch_size = batch_size
+        self.pending = []
+        self.seen_entities = self.load_existing_entities()
+        self.distinct_entity_cache = thread_instance.distinct_entity_cache
+        # Distinct entities inserted by this writer; they only go to the run-wide cache once the file is committed
+        self.new_distinct_ids = {}
+
+    def load_existing_entities(self):
+        # Entities stored for this file by an earlier run are not written again
+        rows = self.db_session.query(DistinctEntitiesTable.distinct_entity, DistinctEntitiesTable.entity_types_id, EntitiesTable.line_number) \
+                              .join(EntitiesTable, EntitiesTable.distinct_entities_id == DistinctEntitiesTable.distinct_entities_id) \
+                              .filter(EntitiesTable.file_id == self.file_metadata.file_id) \
+                              .all()
+        return {tuple(row) for row in rows}
+
+    def add(self, entity_type_id, match_text, start_line, end_line, timestamp, content, content_first_line=0):
+        # content is the list of lines the context is taken from, content_first_line the line number of its first line
+        if (match_text, entity_type_id, start_line) in self.seen_entities:
+            return False
+        return self.add_with_context(entity_type_id, match_text, start_line, timestamp, build_context_snippets(content, start_line - content_first_line, end_line - content_first_line))
+
+    def add_with_context(self, entity_type_id, match_text, line_number, timestamp, context):
+        # For matches whose context was built beforehand, by a file ingestion worker
+        entity_key = (match_text, entity_type_id, line_number)
+        if entity_key in self.seen_entities:
+            return False
+        self.seen_entities.add(entity_key)
+        self.pending.append((match_text, entity_type_id, line_number, timestamp, context))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        new_distinct_ids = dict(self.new_distinct_ids)
+        try:
+            with self.db_session.begin_nested():
+                distinct_ids = self.resolve_distinct_entities({(match_text, entity_type_id) for match_text, entity_type_id, *_ in batch})
+
+                # The processing thread is the only writer, so the ids of the new entities can be assigned up front
+                # and the context rows can reference them without reading every inserted row back
+                first_entity_id = (self.db_session.query(func.max(EntitiesTable.entities_id)).scalar() or 0) + 1
+                entity_rows = []
+                context_rows = []
+                for entities_id, (match_text, entity_type_id, line_number, timestamp, context) in enumerate(batch, start=first_entity_id):
+                    entity_rows.append({
+                        'entities_id': entities_id,
+                        'distinct_entities_id': distinct_ids[(match_text, entity_type_id)],
+                        'entity_types_id': entity_type_id,
+                        'file_id': self.file_metadata.file_id,
+                        'line_number': line_number,
+                        'entry_timestamp': timestamp
+                    })
+                    context_rows.append({
+                        'entities_id': entities_id,
+                        'context_small': context['Single-Line Context'],
+                        'context_medium': context['Medium Context'],
+                        'context_large': context['Large Context']
+                    })
+                self.db_session.execute(EntitiesTable.__table__.insert(), entity_rows)
+                self.db_session.execute(ContextTable.__table__.insert(), context_rows)
+        except Exception as e:
+            logging.error(f"Error writing {len(batch)} entities of {self.file_metadata.file_path}: {e}")
+            self.new_distinct_ids = new_distinct_ids  # Forget the distinct entities rolled back with the savepoint
+            # The entities were not written, so they must not be skipped as duplicates when they are added again
+            self.seen_entities.difference_update((match_text, entity_type_id, line_number) for match_text, entity_type_id, line_number, *_ in batch)
+            return
+
+        self.thread_instance.total_entities_count_lock.lock()  # Lock the mutex
+        try:
+            self.thread_instance.total_entities_count += len(batch)
+        finally:
+            self.thread_instance.total_entities_count_lock.unlock()  # Unlock the mutex
+
+        self.thread_instance.calculate_and_emit_rate()
+
+    def resolve_distinct_entities(self, distinct_keys):
+        distinct_ids = {}
+        texts_by_type = {}
+        for distinct_key in distinct_keys:
+            distinct_entities_id = self.new_distinct_ids.get(distinct_key) or self.distinct_entity_cache.get(distinct_key)
+            if distinct_entities_id is not None:
+                distinct_ids[distinct_key] = distinct_entities_id
+            else:
+                match_text, entity_type_id = distinct_key
+                texts_by_type.setdefault(entity_type_id, []).append(match_text)
+
+        for entity_type_id, texts in texts_by_type.items():
+            existing_ids = self.query_distinct_ids(entity_type_id, texts)
+            for distinct_key, distinct_entities_id in existing_ids.items():
+                self.distinct_entity_cache.put(distinct_key, distinct_entities_id)
+            distinct_ids.update(existing_ids)
+
+            missing_texts = [text for text in texts if (text, entity_type_id) not in distinct_ids]
+            if missing_texts:
+                self.db_session.execute(sqlite_insert(DistinctEntitiesTable.__table__).on_conflict_do_nothing(),
+                                        [{'distinct_entity': text, 'entity_types_id': entity_type_id} for text in missing_texts])
+                inserted_ids = self.query_distinct_ids(entity_type_id, missing_texts)
+                self.new_distinct_ids.update(inserted_ids)
+                distinct_ids.update(inserted_ids)
+        return distinct_ids
+
+    def query_distinct_ids(self, entity_type_id, texts):
+        distinct_ids = {}
+        for i in range(0, len(texts), SQLITE_MAX_IN_PARAMETERS):
+            rows = self.db_session.query(DistinctEntitiesTable.distinct_entity, DistinctEntitiesTable.distinct_entities_id) \
+                                  .filter(DistinctEntitiesTable.entity_types_id == entity_type_id,
+                                          DistinctEntitiesTable.distinct_entity.in_(texts[i:i + SQLITE_MAX_IN_PARAMETERS])) \
+                                  .all()
+            for distinct_entity, distinct_entities_id in rows:
+                distinct_ids[(distinct_entity, entity_type_id)] = distinct_entities_id
+        return distinct_ids
+
+    def finish(self, commit=True):
+        # Without commit, commit() has to be called later
+        self.flush()
+        if commit:
+            self.commit()
+
+    def discard(self, commit=True):
+        # Used on abort: matches which were not written yet are dropped, the written batches are kept
+        self.pending = []
+        if commit:
+            self.commit()
+
+    def commit(self):
+        self.db_session.commit()
+        for distinct_key, distinct_entities_id in self.new_distinct_ids.items():
+            self.distinct_entity_cache.put(distinct_key, distinct_entities_id)
+        self.new_distinct_ids = {}
 
 
 def count_newlines(content, start, end):
     return content[start:end].count('\n')
 
-def handle_context_snippet(db_session, individual_entity, content, start_line, end_line):
-    context_sizes = {
-        'Single-Line Context': 0,
-        'Medium Context': 8,
-        'Large Context': 15
-        #'Index Context': 30
-    }
-
+def build_context_snippets(content, start_line, end_line):
     context_snippets = {}
-    for size, lines in context_sizes.items():
+    for size, lines in CONTEXT_SIZES.items():
         context_start = max(0, start_line - lines)
         context_end = min(len(content), end_line + lines + 1)
         context_snippets[size] = "\n".join(content[context_start:context_end])
-
-    context = ContextTable(entities_id=individual_entity.entities_id,
-                           context_small=context_snippets['Single-Line Context'],
-                           context_medium=context_snippets['Medium Context'],
-                           context_large=context_snippets['Large Context']
-                           )
-    db_session.add(context)
-    db_session.commit()
\ No newline at end of file
+    return context_snippets
@@ -0,0 +1,526 @@
+# Parallel file ingestion: a pool of worker processes reads, parses and puts into context several files at a time,
+# each worker parsing its file with all entity types itself. The matches are sent in batches over one queue to the
+# processing thread, which writes them to the database as its only writer. The queue holds a bounded number of
+# batches; workers producing them faster than the database takes them wait for the writer, so memory stays bounded.
+# The files are handed out by estimated cost, largest first, and large text files are split into segments (see
+# TextSegment), so no single file keeps one worker busy while the others are idle at the end of the run. Small files
+# of the same type are handed out together, see plan_file_tasks.
+
+import os
+import time
+import queue
+import logging
+import mimetypes
+import multiprocessing
+from collections import deque, namedtuple
+from logline_leviathan.file_processor.parser_thread import ParserPool, init_parser_worker, entity_type_time_budget
+from logline_leviathan.file_processor.file_database_ops import build_context_snippets
+from logline_leviathan.file_processor.text_processor import process_text_file, plan_text_segments
+from logline_leviathan.file_processor.xlsx_processor import process_xlsx_file
+from logline_leviathan.file_processor.pdf_processor import process_pdf_file
+from logline_leviathan.file_processor.file_type_cache import sniff_file_type
+from logline_leviathan.file_processor.read_ahead import ReadAhead, READ_AHEAD_ENABLED
+
+PARALLEL_FILE_INGESTION = True
+# Larger text files are split into segments; other larger files are processed one after another instead, with all
+# parser workers working on each of them
+PARALLEL_INGESTION_MAX_FILE_SIZE = 8 * 1024 * 1024
+# Bounds of the segment size: a file is cut into about as many segments as there are workers, within these bounds
+TEXT_SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+TEXT_SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+# Rough processing cost per byte relative to plain text, used to order the files; unlisted types cost 1
+FILE_TYPE_COST_FACTORS = {
+    'application/pdf': 4.0,
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 2.0,
+}
+# Files up to this size are processed in file batches: one task (and one database commit) for many of them instead
+# of one per file. A file batch holds at most FILE_BATCH_MAX_FILES files and about FILE_BATCH_MAX_SIZE bytes.
+FILE_BATCH_MAX_FILE_SIZE = 64 * 1024
+FILE_BATCH_MAX_FILES = 256
+FILE_BATCH_MAX_SIZE = 4 * 1024 * 1024
+# Matches sent to the writer in one batch
+INGESTION_BATCH_SIZE = 1000
+# Batches which may wait for the writer before the workers have to wait
+INGESTION_QUEUE_SIZE = 16
+# File tasks handed to the pool at a time, per worker process
+INGESTION_TASKS_PER_WORKER = 2
+# Seconds between the checks of the time budgets and of the workers being alive
+WORKER_CHECK_INTERVAL = 1.0
+# Seconds a worker collects its messages before putting them on the queue at the end of a file, see flush_messages
+MESSAGE_FLUSH_INTERVAL = 0.05
+
+
+def guess_file_type(file_path):
+    # Small files whose type is not known yet are sniffed by the workers, for planning their type is guessed from the
+    # file name
+    return mimetypes.guess_type(file_path)[0]
+
+
+def file_cost_factor(file_type):
+    return FILE_TYPE_COST_FACTORS.get(file_type, 1.0)
+
+
+# One unit of work for the ingestion workers: files (one, or a file batch of small ones), or a segment of a large
+# text file (then file_paths holds only that file)
+FileTask = namedtuple('FileTask', ['file_paths', 'segment', 'cost'])
+
+
+def plan_file_tasks(file_paths, processes, file_type_cache):
+    # Returns (file tasks ordered by cost, largest first; paths of the large files which cannot be split)
+    file_tasks = []
+    unsplit_paths = []
+    file_batches = {}  # {guessed file type: [file paths, size]} of the file batches being filled
+    for file_path in file_paths:
+        file_size = os.path.getsize(file_path)
+        if file_size <= FILE_BATCH_MAX_FILE_SIZE:
+            file_type = file_type_cache.get(file_path) or guess_file_type(file_path)
+            file_batch = file_batches.setdefault(file_type, [[], 0])
+            file_batch[0].append(file_path)
+            file_batch[1] += file_size
+            if len(file_batch[0]) >= FILE_BATCH_MAX_FILES or file_batch[1] >= FILE_BATCH_MAX_SIZE:
+                file_tasks.append(FileTask(tuple(file_batch[0]), None, file_batch[1] * file_cost_factor(file_type)))
+                del file_batches[file_type]
+            continue
+        if file_size <= PARALLEL_INGESTION_MAX_FILE_SIZE:
+            file_tasks.append(FileTask((file_path,), None, file_size * file_cost_factor(file_type_cache.get(file_path) or guess_file_type(file_path))))
+            continue
+        file_type = file_type_cache.classify(file_path)
+        if 'text/' not in file_type:
+            unsplit_paths.append(file_path)
+            continue
+        segment_size = min(TEXT_SEGMENT_MAX_SIZE, max(TEXT_SEGMENT_MIN_SIZE, file_size // processes))
+        try:
+            segments = plan_text_segments(file_path, segment_size)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not split {file_path} into segments, processing it as a whole: {e}")
+            unsplit_paths.append(file_path)
+            continue
+        for segment in segments:
+            file_tasks.append(FileTask((file_path,), segment, (segment.end - segment.start) * file_cost_factor(file_type)))
+    for file_type, (batch_paths, batch_size) in file_batches.items():
+        file_tasks.append(FileTask(tuple(batch_paths), None, batch_size * file_cost_factor(file_type)))
+    file_tasks.sort(key=lambda file_task: file_task.cost, reverse=True)
+    return file_tasks, unsplit_paths
+
+
+def select_file_processor(file_type):
+    # The process_*_file function for a MIME type, None if the type is not supported
+    if 'text/' in file_type:
+        return process_text_file
+    if file_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        return process_xlsx_file
+    if 'application/pdf' in file_type:
+        return process_pdf_file
+    return None
+
+
+# Worker side. Messages to the writer are tuples (kind, worker pid, file_task_id, ...), put on the queue as lists:
+#   ('start', pid, file_task_id)
+#   ('parse', pid, file_task_id, entity_type_id, time_budget)  parsing of an entity type starts (traced file tasks
+#                                                              only, see ParserPool); entity_type_id None: parsing of
+#                                                              the document ended
+#   ('open', pid, file_task_id, file_path, sheet_name, file_mimetype)  a document (file or sheet) starts
+#   ('entities', pid, file_task_id, file_path, sheet_name, rows)       rows of (entity_type_id, match_text, line,
+#                                                                      timestamp, context)
+#   ('close', pid, file_task_id, file_path, sheet_name, complete)      complete is False if the document was aborted
+#   ('file_done', pid, file_task_id, file_path, file_type, supported)
+#   ('done', pid, file_task_id, parser statistics)
+
+_ingestion_messages = None
+_ingestion_batch_slots = None
+_ingestion_parser = None
+_ingestion_read_ahead = None
+_current_file_task_id = None
+_tracing = False
+_pending_messages = []
+_last_flush = 0.0
+
+
+def init_ingestion_worker(entity_types, messages, batch_slots, line_cache, read_ahead):
+    global _ingestion_messages, _ingestion_batch_slots, _ingestion_parser, _ingestion_read_ahead
+    init_parser_worker(entity_types)
+    _ingestion_messages = messages
+    _ingestion_batch_slots = batch_slots
+    _ingestion_parser = ParserPool(entity_types, line_cache=line_cache, in_process=True, announce_task=announce_parse_task)
+    _ingestion_read_ahead = ReadAhead() if read_ahead else None
+
+
+def send_message(kind, *payload):
+    _pending_messages.append((kind, os.getpid(), _current_file_task_id, *payload))
+    if _tracing:
+        flush_messages()
+
+
+def flush_messages():
+    # The messages of the files done are sent together, at most every MESSAGE_FLUSH_INTERVAL seconds, and before
+    # waiting for the writer. A traced file task sends every message right away.
+    global _pending_messages, _last_flush
+    if _pending_messages:
+        _ingestion_messages.put(_pending_messages)
+        _pending_messages = []
+    _last_flush = time.monotonic()
+
+
+def announce_parse_task(entity_type_id, time_budget):
+    send_message('parse', entity_type_id, time_budget)
+
+
+class NoStatus:
+    # The writer reports the files it receives, the status updates of the processors stay in the worker
+    def emit(self, status):
+        pass
+
+
+class IngestionTaskContext:
+    # Takes the place of the FileProcessorThread for the process_*_file functions in a worker
+    update_status = NoStatus()
+
+    def __init__(self, parser_pool, read_ahead):
+        self.parser_pool = parser_pool
+        self.read_ahead = read_ahead
+
+    def open_entity_writer(self, db_session, file_path, file_mimetype, sheet_name=None):
+        return QueuedEntityWriter(file_path, file_mimetype, sheet_name)
+
+
+class QueuedEntityWriter:
+    # Worker side stand-in for EntityBatchWriter: builds the context of the matches of one document and sends them
+    # to the writer in batches
+
+    def __init__(self, file_path, file_mimetype, sheet_name):
+        self.document = (file_path, sheet_name)
+        self.seen_entities = set()
+        self.pending = []
+        send_message('open', *self.document, file_mimetype)
+
+    def add(self, entity_type_id, match_text, start_line, end_line, timestamp, content, content_first_line=0):
+        entity_key = (match_text, entity_type_id, start_line)
+        if entity_key in self.seen_entities:
+            return False
+        self.seen_entities.add(entity_key)
+        self.pending.append((entity_type_id, match_text, start_line, timestamp, build_context_snippets(content, start_line - content_first_line, end_line - content_first_line)))
+        if len(self.pending) >= INGESTION_BATCH_SIZE:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return
+        flush_messages()
+        _ingestion_batch_slots.acquire()  # Released by the writer once it has written the batch
+        send_message('entities', *self.document, self.pending)
+        self.pending = []
+
+    def finish(self):
+        self.flush()
+        send_message('close', *self.document, True)
+
+    def discard(self):
+        self.pending = []
+        send_message('close', *self.document, False)
+
+
+def ingest_files(file_task_id, file_paths, file_types, segment, excluded_entity_type_ids, trace):
+    # Everything goes to the writer as messages, the last one is 'done'. file_types holds the known type of each file,
+    # None for the files to be sniffed here. A traced file task announces the parse of each entity type, see
+    # FileIngestionScheduler.
+    global _current_file_task_id, _tracing
+    _current_file_task_id = file_task_id
+    _tracing = trace
+    _ingestion_parser.disabled_entity_type_ids = set(excluded_entity_type_ids)
+    _ingestion_parser.announce_task = announce_parse_task if trace else None
+    send_message('start')
+    flush_messages()  # The time budget of the first file runs from here
+    task_context = IngestionTaskContext(_ingestion_parser, _ingestion_read_ahead)
+    if _ingestion_read_ahead is not None:
+        # The next files of the task are read while one is parsed
+        if segment is not None:
+            _ingestion_read_ahead.add_range(file_paths[0], segment.start, segment.end)
+        else:
+            _ingestion_read_ahead.add_files(file_paths)
+    for file_path, known_file_type in zip(file_paths, file_types):
+        file_type = None
+        process_file = None
+        try:
+            file_type = known_file_type or sniff_file_type(file_path)
+            process_file = select_file_processor(file_type)
+            if segment is not None:
+                process_text_file(file_path, file_type, task_context, None, lambda: False, segment)
+            elif process_file is not None:
+                process_file(file_path, file_type, task_context, None, lambda: False)
+        except Exception as e:
+            logging.error(f"Error ingesting file {file_path}: {e}")
+        if _ingestion_read_ahead is not None:
+            _ingestion_read_ahead.done(file_path)
+        send_message('file_done', file_path, file_type, process_file is not None)
+        if time.monotonic() - _last_flush >= MESSAGE_FLUSH_INTERVAL:
+            flush_messages()
+    send_message('done', _ingestion_parser.take_statistics())
+    flush_messages()
+
+
+class FileIngestionScheduler:
+    # Runs in the processing thread: hands the file tasks to the workers and writes what they send, committing once
+    # per file task. The segments of a file share one writer per document. A file task which sends nothing for longer
+    # than its current file may take with all entity types (see ParserPool) is stuck. A worker cannot be stopped on
+    # its own without risking the shared message queue, so all workers are replaced, see recycle_pool: the unfinished
+    # files of the stuck task are processed again as a traced file task, which announces the parse of each entity
+    # type and sends its messages right away. A traced task exceeding the time budget of an entity type has the file
+    # it was stuck in processed again without that entity type. The unfinished files of the other file tasks are
+    # queued again as they were (the entities written for them so far are not written twice).
+
+    def __init__(self, thread_instance, entity_types, line_cache=False, processes=None):
+        self.thread_instance = thread_instance
+        self.parser_pool = thread_instance.parser_pool  # Collects the statistics and time budget overruns of the workers
+        self.processes = processes or os.cpu_count() or 1
+        self.entity_types = entity_types
+        self.line_cache = line_cache
+        self.start_pool()
+        self.db_session = None
+        self.next_file_task_id = 0
+        self.queued_tasks = deque()  # (FileTask, excluded entity type ids, traced) not handed to the pool yet
+        self.file_tasks = {}         # {file_task_id: (FileTask, excluded entity type ids, traced)} handed to the pool
+        self.task_workers = {}       # {file_task_id: pid} of the started file tasks
+        self.task_heard = {}         # {file_task_id: time of its last message} of the started file tasks
+        self.parsing = {}            # {pid: (file_task_id, entity_type_id, time_budget, start time)}
+        self.documents = {}          # {(file_path, sheet_name): [EntityBatchWriter, number of file tasks writing to it]}
+        self.task_documents = {}     # {file_task_id: set of (file_path, sheet_name) the task writes to}
+        self.task_files_done = {}    # {file_task_id: [(file_path, file_type, supported)]} not reported yet
+        self.finished_writers = []   # Writers of complete documents, committed with their file task
+        self.files = {}              # {file_path: [file tasks not done, file type, supported]}
+
+    def run(self, file_tasks, db_session, abort_flag):
+        # Returns False if processing was aborted
+        self.db_session = db_session
+        for file_task in file_tasks:
+            self.queued_tasks.append((file_task, frozenset(), False))
+            for file_path in file_task.file_paths:
+                self.files.setdefault(file_path, [0, None, False])[0] += 1
+        last_check = time.monotonic()
+        try:
+            while self.queued_tasks or self.file_tasks:
+                if abort_flag():
+                    for writer, _ in self.documents.values():
+                        writer.discard()
+                    self.commit_finished_writers()
+                    return False
+                self.submit_file_tasks()
+                self.handle_messages(self.next_messages())
+                if time.monotonic() - last_check >= WORKER_CHECK_INTERVAL:
+                    # Queued messages may show that a worker has moved on or finished its file task
+                    self.drain_messages()
+                    self.check_time_budgets()
+                    self.check_workers()
+                    last_check = time.monotonic()
+            return True
+        finally:
+            # Tasks of terminated workers never finish, so the pool cannot be closed and joined
+            self.pool.terminate()
+            self.pool.join()
+
+    def start_pool(self):
+        # A fresh queue for every pool: a worker terminated while sending a message could leave the old one unusable
+        self.messages = multiprocessing.Queue()
+        self.batch_slots = multiprocessing.Semaphore(INGESTION_QUEUE_SIZE)
+        self.pool = multiprocessing.Pool(self.processes, initializer=init_ingestion_worker,
+                                         initargs=(self.entity_types, self.messages, self.batch_slots, self.line_cache, READ_AHEAD_ENABLED))
+
+    def recycle_pool(self, timed_out_tasks):
+        # Replaces all workers, the only way to stop one which is stuck in a scan. timed_out_tasks holds
+        # {file_task_id: (entity_type_id, time_budget)} of the tasks which exceeded a time budget, entity_type_id None
+        # for a task which went silent. Messages still in the old queue are dropped, what they carried is processed
+        # again.
+        self.pool.terminate()
+        self.pool.join()
+        self.messages.close()
+        self.parsing.clear()
+        requeued = []
+        for file_task_id in list(self.file_tasks):
+            file_task, excluded_entity_type_ids, traced, remaining_paths = self.end_file_task(file_task_id)
+            if file_task_id in timed_out_tasks and remaining_paths:
+                entity_type_id, time_budget = timed_out_tasks[file_task_id]
+                if entity_type_id is None:
+                    # Files done since its last message are processed again too
+                    logging.warning(f"Processing the {len(remaining_paths)} files from {remaining_paths[0]} on exceeded the time budget of {time_budget:.0f}s, processing them again traced")
+                    traced = True
+                else:
+                    stuck_path = remaining_paths.pop(0)  # The files of a task are processed in order
+                    self.parser_pool.record_timeout(entity_type_id, stuck_path, time_budget)
+                    requeued.append((file_task._replace(file_paths=(stuck_path,)), excluded_entity_type_ids | {entity_type_id}, True))
+            if remaining_paths:
+                requeued.append((file_task._replace(file_paths=tuple(remaining_paths)), excluded_entity_type_ids, traced))
+        self.queued_tasks.extendleft(reversed(requeued))
+        self.start_pool()
+
+    def submit_file_tasks(self):
+        while self.queued_tasks and len(self.file_tasks) < self.processes * INGESTION_TASKS_PER_WORKER:
+            file_task, excluded_entity_type_ids, traced = self.queued_tasks.popleft()
+            file_task_id = self.next_file_task_id
+            self.next_file_task_id += 1
+            self.file_tasks[file_task_id] = (file_task, excluded_entity_type_ids, traced)
+            self.task_documents[file_task_id] = set()
+            self.task_files_done[file_task_id] = []
+            file_types = [self.thread_instance.file_type_cache.get(file_path) for file_path in file_task.file_paths]
+            self.pool.apply_async(ingest_files, (file_task_id, file_task.file_paths, file_types, file_task.segment,
+                                                 excluded_entity_type_ids | self.parser_pool.disabled_entity_type_ids, traced))
+
+    def next_messages(self, timeout=0.1):
+        # The messages a worker sent together, see flush_messages
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return []
+
+    def drain_messages(self):
+        while True:
+            try:
+                messages = self.messages.get_nowait()
+            except queue.Empty:
+                return
+            self.handle_messages(messages)
+
+    def handle_messages(self, messages):
+        for message in messages:
+            self.handle_message(message)
+
+    def handle_message(self, message):
+        kind, pid, file_task_id, *payload = message
+        try:
+            if file_task_id not in self.file_tasks:
+                return  # Of a file task which was given up
+            self.task_heard[file_task_id] = time.monotonic()
+            if kind == 'start':
+                self.task_workers[file_task_id] = pid
+            elif kind == 'parse':
+                entity_type_id, time_budget = payload
+                if entity_type_id is None:
+                    self.parsing.pop(pid, None)  # Waiting for the writer does not count against the time budget
+                else:
+                    self.parsing[pid] = (file_task_id, entity_type_id, time_budget, time.monotonic())
+            elif kind == 'open':
+                file_path, sheet_name, file_mimetype = payload
+                document = (file_path, sheet_name)
+                if document not in self.documents:
+                    self.thread_instance.update_status.emit(f"   Processing now: {file_path}")
+                    writer = self.thread_instance.open_entity_writer(self.db_session, file_path, file_mimetype, sheet_name, commit=False)
+                    self.documents[document] = [writer, 0]
+                self.documents[document][1] += 1
+                self.task_documents[file_task_id].add(document)
+            elif kind == 'entities':
+                file_path, sheet_name, rows = payload
+                writer = self.documents[(file_path, sheet_name)][0]
+                for entity_type_id, match_text, line_number, timestamp, context in rows:
+                    writer.add_with_context(entity_type_id, match_text, line_number, timestamp, context)
+            elif kind == 'close':
+                file_path, sheet_name, complete = payload
+                self.task_documents[file_task_id].discard((file_path, sheet_name))
+                self.release_document((file_path, sheet_name), complete)
+            elif kind == 'file_done':
+                file_path, file_type, _ = payload
+                self.thread_instance.file_type_cache.record(file_path, file_type)
+                self.task_files_done[file_task_id].append(tuple(payload))
+            elif kind == 'done':
+                statistics, = payload
+                self.end_file_task(file_task_id)
+                self.parser_pool.add_statistics(statistics)
+        finally:
+            if kind == 'entities':
+                self.batch_slots.release()
+
+    def release_document(self, document, complete=True):
+        # The writer of a document is finished once no file task writes to it any more
+        self.documents[document][1] -= 1
+        if self.documents[document][1] == 0:
+            writer, _ = self.documents.pop(document)
+            if complete:
+                writer.finish(commit=False)
+            else:
+                writer.discard(commit=False)
+            self.finished_writers.append(writer)
+
+    def commit_finished_writers(self):
+        # The first commit covers all of them, the others only pass on their distinct entities to the run-wide cache
+        for writer in self.finished_writers:
+            writer.commit()
+        self.finished_writers = []
+
+    def end_file_task(self, file_task_id):
+        # Commits what the task wrote and reports its files which are done. Documents left open by a terminated
+        # worker keep what was sent for them. Returns (FileTask, excluded entity type ids, traced, the file paths not
+        # done).
+        for document in self.task_documents.pop(file_task_id):
+            self.release_document(document)
+        self.thread_instance.file_type_cache.store(self.db_session)
+        self.db_session.commit()
+        self.commit_finished_writers()
+        pid = self.task_workers.pop(file_task_id, None)
+        self.task_heard.pop(file_task_id, None)
+        if pid in self.parsing and self.parsing[pid][0] == file_task_id:
+            del self.parsing[pid]
+        files_done = self.task_files_done.pop(file_task_id)
+        for file_path, file_type, supported in files_done:
+            self.file_task_done(file_path, file_type, supported)
+        file_task, excluded_entity_type_ids, traced = self.file_tasks.pop(file_task_id)
+        done_paths = {file_path for file_path, _, _ in files_done}
+        return file_task, excluded_entity_type_ids, traced, [file_path for file_path in file_task.file_paths if file_path not in done_paths]
+
+    def file_task_done(self, file_path, file_type, supported):
+        file_state = self.files[file_path]
+        file_state[0] -= 1
+        file_state[1] = file_type or file_state[1]
+        file_state[2] = supported or file_state[2]
+        if file_state[0] == 0:
+            del self.files[file_path]
+            self.thread_instance.file_processed(file_path, file_state[1], file_state[2])
+
+    def check_time_budgets(self):
+        # The parse states have to be up to date, see drain_messages
+        now = time.monotonic()
+        timed_out_tasks = {file_task_id: (entity_type_id, time_budget)
+                           for file_task_id, entity_type_id, time_budget, start_time in self.parsing.values()
+                           if now - start_time > time_budget}
+        for file_task_id, heard_time in self.task_heard.items():
+            file_task, excluded_entity_type_ids, traced = self.file_tasks[file_task_id]
+            if traced:
+                continue
+            entity_type_count = max(len(set(self.parser_pool.parsed_entity_type_ids) - excluded_entity_type_ids - self.parser_pool.disabled_entity_type_ids), 1)
+            if now - heard_time <= entity_type_time_budget(0) * entity_type_count:
+                continue  # Within the budget of any file
+            time_budget = entity_type_time_budget(self.remaining_size(file_task_id)) * entity_type_count
+            if now - heard_time > time_budget:
+                timed_out_tasks[file_task_id] = (None, time_budget)
+        if timed_out_tasks:
+            self.recycle_pool(timed_out_tasks)
+
+    def remaining_size(self, file_task_id):
+        # Size of the largest file of the task not reported as done: the worker may have moved on to any of them
+        file_task, _, _ = self.file_tasks[file_task_id]
+        if file_task.segment is not None:
+            return file_task.segment.end - file_task.segment.start
+        done_paths = {file_path for file_path, _, _ in self.task_files_done[file_task_id]}
+        sizes = [0]
+        for file_path in file_task.file_paths:
+            if file_path not in done_paths:
+                try:
+                    sizes.append(os.path.getsize(file_path))
+                except OSError:
+                    pass
+        return max(sizes)
+
+    def check_workers(self):
+        # A worker which died (e.g. crashed in a native library) never reports its file task as done. Only a traced
+        # task tells which file it died in, the files of any other are processed again traced.
+        live_pids = {process.pid for process in multiprocessing.active_children()}
+        for file_task_id, pid in list(self.task_workers.items()):
+            if pid not in live_pids:
+                file_task, excluded_entity_type_ids, traced, remaining_paths = self.end_file_task(file_task_id)
+                if not remaining_paths:
+                    continue  # Exited after its last file was done, the pool replaces it
+                if not traced:
+                    logging.warning(f"A worker exited unexpectedly, processing its {len(remaining_paths)} unfinished files again traced")
+                    self.queued_tasks.appendleft((file_task._replace(file_paths=tuple(remaining_paths)), excluded_entity_type_ids, True))
+                    continue
+                logging.error(f"The worker processing {remaining_paths[0]} exited unexpectedly")
+                self.file_task_done(remaining_paths[0], None, True)
+                if len(remaining_paths) > 1:
+                    self.queued_tasks.appendleft((file_task._replace(file_paths=tuple(remaining_paths[1:])), excluded_entity_type_ids, True))
@@ -1,12 +1,14 @@
 import time
 import os
 from PyQt5.QtCore import QThread, pyqtSignal, QMutex
-from logline_leviathan.database.database_manager import session_scope
+from logline_leviathan.database.database_manager import session_scope, IngestSessionFactory
 from logline_leviathan.gui.checkbox_panel import CheckboxPanel
-from .text_processor import process_text_file
-from .xlsx_processor import process_xlsx_file
-from .pdf_processor import process_pdf_file
-import magic
+from .parser_thread import ParserPool, load_entity_type_specs
+from .line_cache import LINE_CACHE_ENABLED
+from .file_database_ops import DistinctEntityCache, EntityBatchWriter, handle_file_metadata
+from .file_ingestion import FileIngestionScheduler, select_file_processor, plan_file_tasks, PARALLEL_FILE_INGESTION
+from .file_type_cache import FileTypeCache
+from .read_ahead import ReadAhead, READ_AHEAD_ENABLED
 import logging
 
 
@@ -37,6 +39,10 @@ class FileProcessorThread(QThread):
         self.all_unsupported_files = []
 
         self.checkbox_panel = CheckboxPanel()
+        self.parser_pool = None
+        self.read_ahead = None
+        self.distinct_entity_cache = DistinctEntityCache()
+        self.file_type_cache = FileTypeCache()
 
     @property
     def abort_flag(self):
@@ -52,15 +58,48 @@ class FileProcessorThread(QThread):
         self.abort_mutex.unlock()
     
     def classify_file_type(self, file_path):
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_file(file_path)
-        return file_type
+        return self.file_type_cache.classify(file_path)
+
+    def open_entity_writer(self, db_session, file_path, file_mimetype, sheet_name=None, commit=True):
+        # The processors write the matches of a file (or sheet) through this; in the file ingestion workers it sends
+        # them to this thread instead. Without commit, the file metadata is committed with the entities.
+        return EntityBatchWriter(db_session, handle_file_metadata(db_session, file_path, file_mimetype, sheet_name, commit), self)
+
+    def start_parser_pool(self):
+        with session_scope() as session:
+            entity_types = load_entity_type_specs(session)
+            self.distinct_entity_cache.warm_start(session)
+            self.file_type_cache.load(session, self.file_paths)
+        self.parser_pool = ParserPool(entity_types, line_cache=LINE_CACHE_ENABLED)
+
+    def stop_parser_pool(self):
+        if self.parser_pool is None:
+            return
+        logging.info(self.parser_pool.prefilter_report())
+        timeout_report = self.parser_pool.timeout_report()
+        if timeout_report:
+            logging.warning(timeout_report)
+        if self.parser_pool.line_cache is not None:
+            logging.info(self.parser_pool.line_cache.report())
+        if self.abort_flag:
+            self.parser_pool.terminate()
+        else:
+            self.parser_pool.close()
+        self.parser_pool = None
 
     def run(self):
         try:
-            for index, file_path in enumerate(self.file_paths):
-                file_size_kb = os.path.getsize(file_path) / 1024  # Get file size in KiB
-                self.total_data_processed_kb += file_size_kb
+            self.start_parser_pool()
+            file_tasks, sequential_paths = self.plan_file_ingestion()
+            if file_tasks and not self.ingest_files_in_parallel(file_tasks):
+                self.update_status.emit("Processing aborted.")
+                return
+
+            if READ_AHEAD_ENABLED and sequential_paths:
+                # The next files (and the next chunks of a large file) are read while one is parsed
+                self.read_ahead = ReadAhead()
+                self.read_ahead.add_files(sequential_paths)
+            for file_path in sequential_paths:
                 if self.abort_flag:
                     self.update_status.emit("Processing aborted.")
                     return
@@ -68,29 +107,65 @@ class FileProcessorThread(QThread):
                 file_type = self.classify_file_type(file_path)
                 logging.info(f"Processing {file_type}")
 
-                with session_scope() as session:
-                    if 'text/' in file_type:
-                        process_text_file(file_path, file_type, self, session, lambda: self.abort_flag)
-                    elif file_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
-                        process_xlsx_file(file_path, file_type, self, session, lambda: self.abort_flag)
-                    elif 'application/pdf' in file_type:
-                        process_pdf_file(file_path, file_type, self, session, lambda: self.abort_flag)
-                    else:
-                        logging.info(f"Skipping unsupported file type: {file_type}")
-                        self.all_unsupported_files.append(file_path)
-                        self.unsupported_files_count += 1
-                        if len(self.unsupported_files_list) < 20:
-                            self.unsupported_files_list.append(f"{file_path} (Type: {file_type})")
-                        continue
-                self.update_tree_signal.emit()
-                self.update_checkboxes_signal.emit()
-                self.processed_files_count = index + 1 
-                self.update_progress.emit(index + 1)
-
-            self.update_status.emit(f"   Processing complete. A Total of {index + 1 - self.unsupported_files_count} of {len(self.file_paths)} files processed.")
+                process_file = select_file_processor(file_type)
+                if process_file is not None:
+                    with session_scope(IngestSessionFactory) as session:
+                        process_file(file_path, file_type, self, session, lambda: self.abort_flag)
+                if self.read_ahead is not None:
+                    self.read_ahead.done(file_path)
+                self.file_processed(file_path, file_type, process_file is not None)
+
+            self.update_status.emit(f"   Processing complete. A Total of {self.processed_files_count - self.unsupported_files_count} of {len(self.file_paths)} files processed.")
         except Exception as e:
             logging.error(f"Error processing files: {e}")
             self.update_status.emit(f"Error processing files: {e}")
+        finally:
+            if self.read_ahead is not None:
+                self.read_ahead.close()
+                self.read_ahead = None
+            self.stop_parser_pool()
+            self.store_file_types()
+            logging.info(f"Distinct entity cache: {self.distinct_entity_cache.hits} hits, {self.distinct_entity_cache.misses} misses "
+                         f"({self.distinct_entity_cache.hit_rate():.1%} hit rate, {len(self.distinct_entity_cache)} entries)")
+
+    def plan_file_ingestion(self):
+        # Small files and the segments of large text files are processed in parallel, largest first; other large
+        # files afterwards one after another, each of them parsed by all parser workers
+        if not PARALLEL_FILE_INGESTION:
+            return [], list(self.file_paths)
+        file_tasks, sequential_paths = plan_file_tasks(self.file_paths, os.cpu_count() or 1, self.file_type_cache)
+        if len(file_tasks) < 2:
+            return [], list(self.file_paths)
+        return file_tasks, sequential_paths
+
+    def ingest_files_in_parallel(self, file_tasks):
+        # Returns False if processing was aborted
+        scheduler = FileIngestionScheduler(self, self.parser_pool.entity_types, line_cache=LINE_CACHE_ENABLED)
+        with session_scope(IngestSessionFactory) as session:
+            return scheduler.run(file_tasks, session, lambda: self.abort_flag)
+
+    def store_file_types(self):
+        # The types of the files sniffed here; the file ingestion stores them with its commits
+        try:
+            with session_scope(IngestSessionFactory) as session:
+                self.file_type_cache.store(session)
+        except Exception as e:
+            logging.error(f"Error storing file types: {e}")
+        logging.info(self.file_type_cache.report())
+
+    def file_processed(self, file_path, file_type, supported):
+        self.total_data_processed_kb += os.path.getsize(file_path) / 1024  # File size in KiB
+        self.processed_files_count += 1
+        if supported:
+            self.update_tree_signal.emit()
+            self.update_checkboxes_signal.emit()
+        else:
+            logging.info(f"Skipping unsupported file type: {file_type}")
+            self.all_unsupported_files.append(file_path)
+            self.unsupported_files_count += 1
+            if len(self.unsupported_files_list) < 20:
+                self.unsupported_files_list.append(f"{file_path} (Type: {file_type})")
+        self.update_progress.emit(self.processed_files_count)
 
     def calculate_and_emit_rate(self):
         current_time = time.time()
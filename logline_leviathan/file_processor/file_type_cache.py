@@ -0,0 +1,137 @@
+# MIME types of the input files. Files with an extension from EXTENSION_MIME_TYPES are not sniffed, they get the type
+# of their extension. The other files are sniffed with libmagic, with one handle per process, and the sniffed types are
+# stored in the database keyed by (device, inode, size, mtime): a later run over the same files takes them from there
+# instead of sniffing the files again, a file which was changed or replaced since is sniffed again.
+
+import os
+import logging
+import magic
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from logline_leviathan.database.database_manager import FileTypeCacheTable
+from logline_leviathan.file_processor.file_database_ops import SQLITE_MAX_IN_PARAMETERS
+
+# Extensions whose files are taken to be of the given type without sniffing them. Only extensions which are not used
+# for anything else belong here; a .log file holding JSON lines, for example, is processed as text. Empty files are
+# always sniffed.
+EXTENSION_MIME_TYPES = {
+    '.log': 'text/plain',
+    '.txt': 'text/plain',
+    '.csv': 'text/csv',
+    '.pdf': 'application/pdf',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+# File keys are stored as SQLite integers
+MAX_FILE_KEY_PART = 2 ** 63 - 1
+
+_magic = None
+_magic_pid = None
+
+
+def sniff_file_type(file_path):
+    # The handle is created once per process, a handle inherited from the parent process is not used
+    global _magic, _magic_pid
+    if _magic is None or _magic_pid != os.getpid():
+        _magic = magic.Magic(mime=True)
+        _magic_pid = os.getpid()
+    return _magic.from_file(file_path)
+
+
+def extension_file_type(file_path):
+    return EXTENSION_MIME_TYPES.get(os.path.splitext(file_path)[1].lower())
+
+
+def classify_file_type(file_path):
+    # Without the cache, see FileTypeCache.classify
+    file_type = extension_file_type(file_path)
+    if file_type is not None and os.path.getsize(file_path) > 0:
+        return file_type
+    return sniff_file_type(file_path)
+
+
+def file_key(stat_result):
+    # None if the file cannot be identified reliably (no inode numbers, e.g. on FAT) or the key does not fit
+    key = (stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+    if stat_result.st_ino == 0 or not all(0 <= part <= MAX_FILE_KEY_PART for part in key):
+        return None
+    return key
+
+
+class FileTypeCache:
+    # The file types of one processing run: load() takes the types of the files from their extension or from the
+    # database, classify() sniffs the others, or the file ingestion workers sniff them and pass them on to record().
+    # store() writes the types sniffed during the run to the database.
+
+    def __init__(self):
+        self.file_keys = {}   # {file_path: file key}
+        self.file_types = {}  # {file_path: MIME type}
+        self.sniffed = {}     # {file key: MIME type} not stored yet
+        self.extension_files = 0
+        self.cached_files = 0
+        self.sniffed_files = 0
+
+    def load(self, db_session, file_paths):
+        unknown_files = {}  # {file key: [file paths]}
+        for file_path in file_paths:
+            try:
+                stat_result = os.stat(file_path)
+            except OSError:
+                continue  # Reported when the file is processed
+            key = file_key(stat_result)
+            self.file_keys[file_path] = key
+            file_type = extension_file_type(file_path) if stat_result.st_size > 0 else None
+            if file_type is not None:
+                self.file_types[file_path] = file_type
+                self.extension_files += 1
+            elif key is not None:
+                unknown_files.setdefault(key, []).append(file_path)
+
+        keys = list(unknown_files)
+        step = SQLITE_MAX_IN_PARAMETERS // 4
+        key_columns = tuple_(FileTypeCacheTable.device, FileTypeCacheTable.inode, FileTypeCacheTable.size, FileTypeCacheTable.mtime_ns)
+        for i in range(0, len(keys), step):
+            rows = db_session.query(FileTypeCacheTable.device, FileTypeCacheTable.inode, FileTypeCacheTable.size, FileTypeCacheTable.mtime_ns, FileTypeCacheTable.file_mimetype) \
+                             .filter(key_columns.in_(keys[i:i + step])) \
+                             .all()
+            for device, inode, size, mtime_ns, file_mimetype in rows:
+                for file_path in unknown_files[(device, inode, size, mtime_ns)]:
+                    self.file_types[file_path] = file_mimetype
+                    self.cached_files += 1
+
+    def get(self, file_path):
+        # None if the file has to be sniffed
+        return self.file_types.get(file_path)
+
+    def classify(self, file_path):
+        file_type = self.file_types.get(file_path)
+        if file_type is None:
+            file_type = sniff_file_type(file_path)
+            self.record(file_path, file_type)
+        return file_type
+
+    def record(self, file_path, file_type):
+        # A type sniffed for one of the files of the run
+        if file_type is None or file_path in self.file_types:
+            return
+        self.file_types[file_path] = file_type
+        self.sniffed_files += 1
+        key = self.file_keys.get(file_path)
+        if key is not None:
+            self.sniffed[key] = file_type
+
+    def store(self, db_session):
+        # Committed with the session
+        if not self.sniffed:
+            return
+        sniffed, self.sniffed = self.sniffed, {}
+        try:
+            with db_session.begin_nested():
+                db_session.execute(sqlite_insert(FileTypeCacheTable.__table__).on_conflict_do_nothing(),
+                                   [{'device': device, 'inode': inode, 'size': size, 'mtime_ns': mtime_ns, 'file_mimetype': file_mimetype}
+                                    for (device, inode, size, mtime_ns), file_mimetype in sniffed.items()])
+        except Exception as e:
+            logging.error(f"Error storing the types of {len(sniffed)} files: {e}")
+
+    def report(self):
+        return (f"File types: {self.extension_files} files by extension, {self.cached_files} from earlier runs, "
+                f"{self.sniffed_files} sniffed")
@@ -0,0 +1,103 @@
+# Line deduplication cache: logs repeat identical lines (health checks, heartbeats) thousands of times. With the cache,
+# every distinct line is parsed once per processing run and its matches are remembered relative to the line; further
+# occurrences of the line reuse them. Of a document only the lines not seen before are parsed, joined into one
+# document of distinct lines.
+# This assumes that entities do not span lines and do not depend on the lines around them. A document in which a
+# match crosses a line border is parsed as a whole instead.
+# Only the matches of complete parses are cached: not if an entity type was given up on the document (time budget,
+# see ParserPool) or the parse was aborted. The cache starts over whenever the set of entity types parsed changes.
+
+import logging
+import numpy as np
+
+# Off by default, see the assumption above
+LINE_CACHE_ENABLED = False
+# Bounds the number of cached lines; the cache starts over when it is full
+LINE_CACHE_SIZE = 200000
+# Longer lines are parsed but not cached, they rarely repeat
+LINE_CACHE_MAX_LINE_LENGTH = 4096
+
+
+class LineParseCache:
+
+    def __init__(self, max_lines=LINE_CACHE_SIZE, max_line_length=LINE_CACHE_MAX_LINE_LENGTH):
+        self.max_lines = max_lines
+        self.max_line_length = max_line_length
+        # {line: ((entity_type_id, match_text, start, end), ...)} with positions relative to the start of the line
+        self.line_matches = {}
+        self.entity_type_ids = None  # The entity types the cached matches were found with
+        self.looked_up_lines = 0
+        self.reused_lines = 0
+        self.uncached_documents = 0
+
+    def parse(self, content, parse_function, abort_flag, entity_type_ids):
+        # parse_function(content, abort_flag) parses a document, returns ([(entity_type_id, match_text, start, end)],
+        # whether all entity_type_ids were parsed to the end)
+        if entity_type_ids != self.entity_type_ids:
+            self.line_matches.clear()
+            self.entity_type_ids = entity_type_ids
+        matches = []
+        lines = content.split('\n')
+        occurrences = {}  # Positions of the lines which are not cached yet
+        position = 0
+        for line in lines:
+            if line:
+                line_matches = self.line_matches.get(line)
+                if line_matches is not None:
+                    matches.extend((entity_type_id, match_text, position + start, position + end) for entity_type_id, match_text, start, end in line_matches)
+                else:
+                    occurrences.setdefault(line, []).append(position)
+            position += len(line) + 1
+        line_count = len(lines) - lines.count('')
+        self.looked_up_lines += line_count
+        self.reused_lines += line_count - len(occurrences)
+        if not occurrences:
+            return matches
+
+        distinct_lines = list(occurrences)
+        distinct_content = '\n'.join(distinct_lines) + '\n'
+        line_starts = np.cumsum([0] + [len(line) + 1 for line in distinct_lines])
+        distinct_matches, complete = parse_function(distinct_content, abort_flag)
+        if abort_flag():
+            return matches  # Incomplete, nothing to cache
+
+        matches_by_line = [[] for _ in distinct_lines]
+        if distinct_matches:
+            start_positions = np.fromiter((match[2] for match in distinct_matches), dtype=np.int64, count=len(distinct_matches))
+            end_positions = np.fromiter((match[3] for match in distinct_matches), dtype=np.int64, count=len(distinct_matches))
+            line_numbers = np.searchsorted(line_starts, start_positions, side='right') - 1
+            # The line break in front of the next line is the last character a match may end with
+            if (end_positions > line_starts[line_numbers + 1] - 1).any():
+                logging.debug("Match crosses a line border, parsing the document without the line cache")
+                self.uncached_documents += 1
+                return parse_function(content, abort_flag)[0]
+            for (entity_type_id, match_text, start, end), line_number, line_start in zip(distinct_matches, line_numbers.tolist(), line_starts[line_numbers].tolist()):
+                matches_by_line[line_number].append((entity_type_id, match_text, start - line_start, end - line_start))
+
+        for line, line_matches in zip(distinct_lines, matches_by_line):
+            line_matches = tuple(line_matches)
+            for position in occurrences[line]:
+                matches.extend((entity_type_id, match_text, position + start, position + end) for entity_type_id, match_text, start, end in line_matches)
+            if complete and len(line) <= self.max_line_length:
+                if len(self.line_matches) >= self.max_lines:
+                    self.line_matches.clear()
+                self.line_matches[line] = line_matches
+        return matches
+
+    def take_statistics(self):
+        # The counters collected since the last call, see ParserPool.take_statistics
+        statistics = (self.looked_up_lines, self.reused_lines, self.uncached_documents)
+        self.looked_up_lines = self.reused_lines = self.uncached_documents = 0
+        return statistics
+
+    def add_statistics(self, statistics):
+        looked_up_lines, reused_lines, uncached_documents = statistics
+        self.looked_up_lines += looked_up_lines
+        self.reused_lines += reused_lines
+        self.uncached_documents += uncached_documents
+
+    def report(self):
+        # Covers the caches of all processes whose statistics were added
+        hit_rate = self.reused_lines / self.looked_up_lines if self.looked_up_lines else 0
+        return (f"Line cache reused the matches of {self.reused_lines} of {self.looked_up_lines} lines ({hit_rate:.1%}), "
+                f"{self.uncached_documents} documents parsed without it")
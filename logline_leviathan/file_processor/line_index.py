@@ -0,0 +1,69 @@
+import numpy as np
+
+
+def find_newline_positions(content):
+    # Character offsets of all '\n' in the content, found in one vectorized pass over the encoded text.
+    # ASCII content maps one byte to one character, otherwise UTF-32 keeps one code unit per character.
+    # Bytes content (ASCII text files scanned without decoding) is used as it is.
+    if not isinstance(content, str):
+        code_units = np.frombuffer(content, dtype=np.uint8)
+    elif content.isascii():
+        code_units = np.frombuffer(content.encode('ascii'), dtype=np.uint8)
+    else:
+        code_units = np.frombuffer(content.encode('utf-32-le'), dtype='<u4')
+    return np.flatnonzero(code_units == 10)
+
+
+class LineIndex:
+    # Maps character offsets of a document to 0-based line numbers; built once per document (text file, PDF page or
+    # XLSX sheet) and queried for all matches of the document at once
+
+    def __init__(self, content):
+        self.newline_positions = find_newline_positions(content)
+
+    def line_numbers(self, positions):
+        # The line of a position is the number of line breaks in front of it
+        return np.searchsorted(self.newline_positions, np.asarray(positions, dtype=np.int64), side='left')
+
+    def match_lines(self, matches):
+        # matches are (entity_type_id, match_text, start_pos, end_pos) tuples as returned by parse_content;
+        # returns the start and end line of every match as plain ints, ready to be written to the database
+        if not matches:
+            return [], []
+        start_positions = np.fromiter((match[2] for match in matches), dtype=np.int64, count=len(matches))
+        end_positions = np.fromiter((match[3] for match in matches), dtype=np.int64, count=len(matches))
+        start_lines = self.line_numbers(start_positions)
+        end_lines = self.line_numbers(np.maximum(end_positions - 1, start_positions))
+        return start_lines.tolist(), end_lines.tolist()
+
+
+class EncodedLines:
+    # The lines of an ASCII encoded text as a read-only list, like file.readlines() would return them. Lines are only
+    # decoded when they are accessed, i.e. for the context of the matches.
+
+    def __init__(self, data):
+        self.data = data
+        line_ends = find_newline_positions(data) + 1
+        self.line_starts = np.concatenate(([0], line_ends[line_ends < len(data)])).tolist()
+        self.line_starts.append(len(data))
+        self.decoded_lines = {}
+
+    def __len__(self):
+        return len(self.line_starts) - 1
+
+    def line(self, index):
+        try:
+            return self.decoded_lines[index]
+        except KeyError:
+            line = self.data[self.line_starts[index]:self.line_starts[index + 1]].decode('ascii')
+            self.decoded_lines[index] = line
+            return line
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.line(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        return self.line(index)
@@ -2,20 +2,191 @@
 
 import os
 import re
+import time
+import queue
 import logging
 import importlib
+import functools
 import multiprocessing
+from collections import namedtuple, Counter
 from logline_leviathan.database.database_manager import EntityTypesTable
+from logline_leviathan.file_processor.prefilter import required_literals, contains_any_literal
+from logline_leviathan.file_processor.shared_content import SHARED_CONTENT_MIN_SIZE, SharedContentHandle, MappedContentHandle, ensure_shared_content_tracking, share_content, release_shared_content, resolve_content, map_content_file, read_mapped_content, read_mapped_range
+from logline_leviathan.file_processor.line_cache import LineParseCache
+from logline_leviathan.file_processor.regex_engine import compile_pattern, matches_alike_as_bytes
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Script parsers of API version 2 are handed memory-mapped files in pieces of this many characters (plus their
+# MAX_MATCH_LENGTH in front of and behind each piece), so the file is never decoded as a whole
+SCRIPT_PARSER_CHUNK_SIZE = 1024 * 1024
+
+# Time an entity type may take to parse one document (text file chunk, PDF or sheet) before its worker is considered
+# hung, e.g. in the catastrophic backtracking of a regex: a base time plus an allowance per MiB of content
+ENTITY_TYPE_TIME_BUDGET = 60.0
+ENTITY_TYPE_TIME_BUDGET_PER_MIB = 10.0
+# Entity types exceeding their time budget this often are not parsed any more for the rest of the run
+MAX_ENTITY_TYPE_TIMEOUTS = 3
+
+
+# Plain, picklable snapshot of an EntityTypesTable row, handed to the worker processes once at pool start
+EntityTypeSpec = namedtuple('EntityTypeSpec', ['entity_type_id', 'entity_type', 'regex_pattern', 'script_parser', 'parent_type', 'regex_engine'])
+
+# Per-worker registry, filled by init_parser_worker when the worker process starts
+_worker_entity_types = {}
+_worker_parser_modules = {}
+# {parent entity_type_id: [child entity_type_id]} of the classifier entity types, see find_classifier_entity_types
+_worker_classifier_children = {}
+# Per-worker cache of the bytes versions of the regex patterns by (pattern, engine), None for patterns which only
+# work on str
+_worker_bytes_patterns = {}
+# Regex engine passed to the use_regex_engine of each script parser module in this process, {module name: engine};
+# forked workers inherit it, together with what the parsers prepared, see prepare_script_parsers
+_applied_regex_engines = {}
+# Queue on which the worker announces the id of every task it starts, so the pool can tell running from queued tasks
+_worker_task_starts = None
+
+
+def load_entity_type_specs(db_session):
+    return [EntityTypeSpec(et.entity_type_id, et.entity_type, et.regex_pattern, et.script_parser, et.parent_type, et.regex_engine)
+            for et in db_session.query(EntityTypesTable).all()]
+
+
+def has_script_parser(entity_type):
+    return bool(entity_type.script_parser) and os.path.exists(os.path.join('data', 'parser', entity_type.script_parser))
+
+
+def script_parser_module_name(entity_type):
+    # 'ipv6.py' -> 'data.parser.ipv6'
+    return "data.parser." + entity_type.script_parser.replace('.py', '')
+
+
+def find_classifier_entity_types(entity_types):
+    # Child entity types whose script parser provides classify(match_texts) are not searched for in the document:
+    # their matches are the matches of the parent entity type which classify() accepts (it returns one bool per
+    # match text), e.g. private and public addresses among the IPv4 addresses. The parent has to find its matches
+    # itself, classifiers are not chained. Returns {parent entity_type_id: [child entity_type_id]}.
+    entity_types_by_name = {entity_type.entity_type: entity_type for entity_type in entity_types}
+    classifier_children = {}
+    for entity_type in entity_types:
+        parent = entity_types_by_name.get(entity_type.parent_type)
+        if parent is None or not has_script_parser(entity_type) or not (parent.regex_pattern or has_script_parser(parent)):
+            continue
+        if has_script_parser(parent) and hasattr(load_script_parser(parent), 'classify'):
+            continue  # The parent is a classifier itself
+        if hasattr(load_script_parser(entity_type), 'classify'):
+            classifier_children.setdefault(parent.entity_type_id, []).append(entity_type.entity_type_id)
+    return classifier_children
+
+
+def load_script_parser(entity_type):
+    parser_module_name = script_parser_module_name(entity_type)
+    try:
+        return _worker_parser_modules.get(parser_module_name) or importlib.import_module(parser_module_name)
+    except Exception as e:
+        logging.error(f"Error loading parser module {parser_module_name}: {e}")
+        return None
+
+
+def entity_type_prefilter_literals(entity_type):
+    # Declared by the script parser, or derived from the regex; None if the entity type cannot be prefiltered
+    if has_script_parser(entity_type):
+        parser_module = load_script_parser(entity_type)
+        if parser_module is None or parser_api_version(parser_module) < 2:
+            return None
+        return tuple(getattr(parser_module, 'PREFILTER_LITERALS', None) or ()) or None
+    if entity_type.regex_pattern:
+        return required_literals(entity_type.regex_pattern)
+    return None
+
+
+def init_parser_worker(entity_types, task_starts=None):
+    # Runs once per worker process: registers the entity types and imports all script parsers up front,
+    # so individual parse tasks only carry the entity type id and the content
+    global _worker_task_starts
+    _worker_task_starts = task_starts
+    _worker_entity_types.clear()
+    for entity_type in entity_types:
+        _worker_entity_types[entity_type.entity_type_id] = entity_type
+        if has_script_parser(entity_type):
+            parser_module = load_script_parser(entity_type)
+            if parser_module is not None:
+                _worker_parser_modules[script_parser_module_name(entity_type)] = parser_module
+                apply_regex_engine(entity_type, parser_module)
+    _worker_classifier_children.clear()
+    _worker_classifier_children.update(find_classifier_entity_types(entity_types))
+
+
+def apply_regex_engine(entity_type, parser_module):
+    # Not again in a forked worker which inherited it, that would discard what the parser prepared with it
+    parser_module_name = script_parser_module_name(entity_type)
+    if entity_type.regex_engine and hasattr(parser_module, 'use_regex_engine') and _applied_regex_engines.get(parser_module_name) != entity_type.regex_engine:
+        parser_module.use_regex_engine(functools.partial(compile_pattern, engine=entity_type.regex_engine))
+        _applied_regex_engines[parser_module_name] = entity_type.regex_engine
+
+
+def prepare_script_parsers(entity_types):
+    # Runs in the processing thread before the parser workers are started: script parsers with an expensive setup
+    # do it once here, forked workers inherit the result instead of repeating it
+    for entity_type in entity_types:
+        if not has_script_parser(entity_type):
+            continue
+        parser_module = load_script_parser(entity_type)
+        if parser_module is None or not hasattr(parser_module, 'prepare'):
+            continue
+        apply_regex_engine(entity_type, parser_module)
+        try:
+            parser_module.prepare()
+        except Exception as e:
+            logging.error(f"Error preparing parser module {script_parser_module_name(entity_type)}: {e}")
+
+
+# Script parser contract:
+#   parse(text) -> [(match_text, start, end)]  (legacy, API version 1) over the whole document
+#   API version 2 modules set PARSER_API_VERSION = 2 and provide
+#     parse_iter(chunk, base_offset)  generator of (match_text, start, end), positions offset by base_offset
+#     PREFILTER_LITERALS  optional; the parser is only run on content containing at least one of these strings
+#                         (checked by ParserPool before the content is handed out)
+#     MAX_MATCH_LENGTH  optional; the longest possible match, allows the content to be handed over in chunks
+#   Optional for both versions:
+#     classify(match_texts)  see find_classifier_entity_types
+#     use_regex_engine(compile_pattern)  called once per worker when the entity type declares a regex_engine;
+#                                        compile_pattern(pattern, flags=0) compiles with that engine (flags have to
+#                                        be passed by keyword), see regex_engine.py
+#     prepare()  called once in the processing thread before the workers start, see prepare_script_parsers
+def parser_api_version(parser_module):
+    return getattr(parser_module, 'PARSER_API_VERSION', 1) if hasattr(parser_module, 'parse_iter') else 1
+
+
+def iter_mapped_script_matches(parser_module, handle):
+    # Decodes and parses the mapped range piece by piece. Each piece is extended by MAX_MATCH_LENGTH on both sides,
+    # so matches crossing its borders are complete and see their surroundings; of those only the ones starting
+    # within the piece are kept.
+    max_match_length = getattr(parser_module, 'MAX_MATCH_LENGTH', None)
+    if max_match_length is None or handle.end - handle.start <= SCRIPT_PARSER_CHUNK_SIZE:
+        yield from parser_module.parse_iter(read_mapped_content(handle), 0)
+        return
+    mapped_file = map_content_file(handle.path)
+    for chunk_start in range(handle.start, handle.end, SCRIPT_PARSER_CHUNK_SIZE):
+        chunk_end = min(chunk_start + SCRIPT_PARSER_CHUNK_SIZE, handle.end)
+        text_start = max(handle.start, chunk_start - max_match_length)
+        text = mapped_file[text_start:min(handle.end, chunk_end + max_match_length)].decode('ascii')
+        for match in parser_module.parse_iter(text, text_start - handle.start):
+            if chunk_start - handle.start <= match[1] < chunk_end - handle.start:
+                yield match
+
 
 def parse_with_script(parser_module_name, full_content):
     parser_module_name = parser_module_name.replace('.py', '')  # Ensure no .py extension
     try:
         #logging.debug(f"Loading script parser module: {parser_module_name}")
-        parser_module = importlib.import_module(parser_module_name)
-        script_results = parser_module.parse(full_content)
+        parser_module = _worker_parser_modules.get(parser_module_name) or importlib.import_module(parser_module_name)
+        if parser_api_version(parser_module) < 2:
+            script_results = parser_module.parse(resolve_content(full_content))
+        elif isinstance(full_content, MappedContentHandle):
+            script_results = list(iter_mapped_script_matches(parser_module, full_content))
+        else:
+            script_results = list(parser_module.parse_iter(resolve_content(full_content), 0))
         #logging.debug(f"Script parser results: {script_results}")
         return script_results
     except (ImportError, AttributeError) as e:
@@ -23,11 +194,40 @@ def parse_with_script(parser_module_name, full_content):
         return []
 
 
+def compile_bytes_pattern(regex_pattern, regex_engine=None):
+    try:
+        return _worker_bytes_patterns[(regex_pattern, regex_engine)]
+    except KeyError:
+        pass
+    bytes_pattern = None  # Parsed on the decoded content instead
+    # Compiled as bytes, an ASCII pattern finds the same matches on ASCII content unless it uses a character class
+    # whose meaning differs between bytes and str, see matches_alike_as_bytes
+    if matches_alike_as_bytes(regex_pattern):
+        try:
+            bytes_pattern = compile_pattern(regex_pattern.encode('ascii'), regex_engine)
+        except (UnicodeEncodeError, re.error):
+            pass  # Non-ASCII literals or str-only flags
+    _worker_bytes_patterns[(regex_pattern, regex_engine)] = bytes_pattern
+    return bytes_pattern
+
 
-def parse_with_regex(regex_pattern, full_content):
+def parse_mapped_with_regex(bytes_pattern, handle):
+    # Scans the memory-mapped file directly, only the matches are decoded. Positions are relative to the start of
+    # the handle, the same as for str content.
+    mapped_file = map_content_file(handle.path)
+    return [(match.group().decode('ascii'), match.start() - handle.start, match.end() - handle.start)
+            for match in bytes_pattern.finditer(mapped_file, handle.start, handle.end)]
+
+
+def parse_with_regex(regex_pattern, full_content, regex_engine=None):
+    if isinstance(full_content, MappedContentHandle):
+        bytes_pattern = compile_bytes_pattern(regex_pattern, regex_engine)
+        if bytes_pattern is not None:
+            return parse_mapped_with_regex(bytes_pattern, full_content)
+    full_content = resolve_content(full_content)
     try:
         #logging.debug(f"Using regex pattern: {regex_pattern}")
-        regex_results = [(match.group(), match.start(), match.end()) for match in re.finditer(regex_pattern, full_content)]
+        regex_results = [(match.group(), match.start(), match.end()) for match in compile_pattern(regex_pattern, regex_engine).finditer(full_content)]
         #logging.debug(f"Regex parser results: {regex_results}")
         return regex_results
     except re.error as e:
@@ -37,15 +237,13 @@ def parse_with_regex(regex_pattern, full_content):
 
 def parse_entity_type(entity_type, full_content):
     try:
-        if entity_type.script_parser and os.path.exists(os.path.join('data', 'parser', entity_type.script_parser)):
-            # Assuming script_parser contains something like 'ipv6.py'
-            # Convert this to 'data.parser.ipv6'
-            parser_module_name = "data.parser." + entity_type.script_parser.replace('.py', '')
+        if has_script_parser(entity_type):
+            parser_module_name = script_parser_module_name(entity_type)
             #logging.debug(f"Attempting script-based parsing with: {parser_module_name}")
             return [(entity_type.entity_type_id, *match) for match in parse_with_script(parser_module_name, full_content)]
         elif entity_type.regex_pattern:
             #logging.debug(f"Attempting regex-based parsing with: {entity_type.regex_pattern}")
-            return [(entity_type.entity_type_id, *match) for match in parse_with_regex(entity_type.regex_pattern, full_content)]
+            return [(entity_type.entity_type_id, *match) for match in parse_with_regex(entity_type.regex_pattern, full_content, entity_type.regex_engine)]
         else:
             #logging.debug(f"No parser found for entity type: {entity_type}")
             return []
@@ -56,24 +254,308 @@ def parse_entity_type(entity_type, full_content):
 
 
 
-def parse_content(full_content, abort_flag, db_session):
-    #logging.debug("Starting parsing content")
-    entity_types = db_session.query(EntityTypesTable).all()
+def parse_registered_entity_type(entity_type_id, content):
+    entity_type = _worker_entity_types.get(entity_type_id)
+    if entity_type is None:
+        logging.error(f"Entity type {entity_type_id} is not registered in this parser worker")
+        return []
+    matches = parse_entity_type(entity_type, content)
+    return matches + classify_child_matches(entity_type_id, matches)
+
+
+def classify_child_matches(parent_entity_type_id, parent_matches):
+    child_matches = []
+    if not parent_matches:
+        return child_matches
+    match_texts = [match[1] for match in parent_matches]
+    for entity_type_id in _worker_classifier_children.get(parent_entity_type_id, ()):
+        entity_type = _worker_entity_types[entity_type_id]
+        try:
+            accepted = load_script_parser(entity_type).classify(match_texts)
+            child_matches.extend((entity_type_id, *match[1:]) for match, is_accepted in zip(parent_matches, accepted) if is_accepted)
+        except Exception as e:
+            logging.error(f"Error classifying matches for {entity_type}: {e}")
+    return child_matches
+
+
+def parse_registered_entity_types(entity_type_ids, content, task_id=None):
+    # One parse task: one or several entity types sharing one copy of the content
+    if task_id is not None and _worker_task_starts is not None:
+        _worker_task_starts.put(task_id)
     matches = []
+    for entity_type_id in entity_type_ids:
+        matches.extend(parse_registered_entity_type(entity_type_id, content))
+    return matches
+
+
+def entity_type_time_budget(size):
+    # Seconds the parse of one entity type may take on content of size bytes
+    return ENTITY_TYPE_TIME_BUDGET + ENTITY_TYPE_TIME_BUDGET_PER_MIB * size / (1024 * 1024)
+
+
+class ParserPool:
+    # Long-lived pool of parser processes, started once per processing run instead of once per file, page or sheet
+
+    def __init__(self, entity_types, processes=None, line_cache=False, in_process=False, announce_task=None):
+        self.entity_types = entity_types
+        self.processes = processes
+        # Without worker processes (in_process) the entity types are parsed one after another in the calling process,
+        # announce_task(entity_type_id, time_budget) is called before each of them and announce_task(None, None) after
+        # the last one; see file_ingestion.py
+        self.in_process = in_process
+        self.announce_task = announce_task
+        # Category entity types have neither a regex nor a script parser, there is nothing to parse for them
+        # Classifier entity types are evaluated within the task of their parent entity type
+        classifier_entity_type_ids = {entity_type_id for children in find_classifier_entity_types(entity_types).values() for entity_type_id in children}
+        self.parsed_entity_type_ids = [et.entity_type_id for et in entity_types
+                                       if (et.regex_pattern or has_script_parser(et)) and et.entity_type_id not in classifier_entity_type_ids]
+        # Entity types are only scanned for in content containing one of their literals, see prefilter.py
+        self.prefilter_literals = {}
+        for et in entity_types:
+            literals = entity_type_prefilter_literals(et) if et.entity_type_id in self.parsed_entity_type_ids else None
+            if literals:
+                self.prefilter_literals[et.entity_type_id] = literals
+        self.prefilter_checks = Counter()
+        self.prefilter_skips = Counter()
+        # Optional run-wide cache of the matches of repeated lines, see line_cache.py
+        self.line_cache = LineParseCache() if line_cache else None
+        # Parse tasks exceeding their time budget: {(entity_type_id, source): count}, see collect_results
+        self.timeouts = Counter()
+        self.disabled_entity_type_ids = set()
+        self.next_task_id = 0
+        self.finished_tasks = queue.Queue()  # Ids of the finished tasks, put there by the result callbacks
+        self.task_start_times = {}
+        self.pool = None  # Started for the first document which is parsed by the workers
+        if not in_process:
+            ensure_shared_content_tracking()
+            prepare_script_parsers(entity_types)
+
+    def start_pool(self):
+        # A fresh queue for every pool: a worker terminated while announcing a task could leave the old one unusable
+        self.task_starts = multiprocessing.SimpleQueue()
+        self.pool = multiprocessing.Pool(processes=self.processes, initializer=init_parser_worker, initargs=(self.entity_types, self.task_starts))
+
+    def recycle_pool(self):
+        # Replaces all workers, the only way to stop one which is stuck in a scan
+        self.pool.terminate()
+        self.pool.join()
+        self.task_starts.close()
+        self.task_start_times.clear()
+        self.start_pool()
+
+    def parse(self, full_content, abort_flag, source=None):
+        # source names the document (its file) in the time budget report
+        parse_document = functools.partial(self.parse_document, source=source)
+        if self.line_cache is None:
+            return parse_document(full_content, abort_flag)[0]
+        if isinstance(full_content, MappedContentHandle):
+            full_content = read_mapped_range(full_content)  # The lines are looked up in the decoded content
+        active_entity_type_ids = frozenset(entity_type_id for entity_type_id in self.parsed_entity_type_ids if entity_type_id not in self.disabled_entity_type_ids)
+        return self.line_cache.parse(full_content, parse_document, abort_flag, active_entity_type_ids)
+
+    def parse_document(self, full_content, abort_flag, source=None):
+        # Returns (matches, whether every entity type was parsed to the end)
+        entity_type_ids = self.prefilter_entity_types(full_content)
+        if not entity_type_ids:
+            return [], True
+        if self.in_process:
+            # A worker exceeding a time budget is terminated, so an in-process parse which returns is complete
+            return self.parse_in_process(full_content, entity_type_ids), True
+        if isinstance(full_content, MappedContentHandle):
+            return self.collect_results(full_content, abort_flag, entity_type_ids, source=source)  # The workers map the file themselves
+        # Larger documents are placed into shared memory once, the tasks then only carry a handle to it
+        shm = None
+        content = full_content
+        if len(full_content) >= SHARED_CONTENT_MIN_SIZE:
+            shm, content = share_content(full_content)
+        try:
+            return self.collect_results(content, abort_flag, entity_type_ids, source=source)
+        finally:
+            if shm is not None:
+                release_shared_content(shm)
+
+    def prefilter_entity_types(self, full_content):
+        # The entity types which can have matches in the content
+        if isinstance(full_content, MappedContentHandle):
+            content, start, end = map_content_file(full_content.path), full_content.start, full_content.end
+        else:
+            content, start, end = full_content, 0, len(full_content)
+        found = {}  # Several entity types often share their literals
+        entity_type_ids = []
+        for entity_type_id in self.parsed_entity_type_ids:
+            if entity_type_id in self.disabled_entity_type_ids:
+                continue
+            literals = self.prefilter_literals.get(entity_type_id)
+            if literals:
+                self.prefilter_checks[entity_type_id] += 1
+                if literals not in found:
+                    found[literals] = contains_any_literal(literals, content, start, end)
+                if not found[literals]:
+                    self.prefilter_skips[entity_type_id] += 1
+                    continue
+            entity_type_ids.append(entity_type_id)
+        return entity_type_ids
+
+    def parse_in_process(self, content, entity_type_ids):
+        # The entity types have to be registered in this process, see init_parser_worker
+        time_budget = self.time_budget(content)
+        matches = []
+        for entity_type_id in entity_type_ids:
+            if self.announce_task is not None:
+                self.announce_task(entity_type_id, time_budget)
+            matches.extend(parse_registered_entity_types([entity_type_id], content))
+        if self.announce_task is not None:
+            self.announce_task(None, None)
+        return matches
+
+    def take_statistics(self):
+        # The counters collected since the last call, to be merged into another pool's with add_statistics
+        statistics = (self.prefilter_checks, self.prefilter_skips, self.line_cache.take_statistics() if self.line_cache is not None else None)
+        self.prefilter_checks = Counter()
+        self.prefilter_skips = Counter()
+        return statistics
+
+    def add_statistics(self, statistics):
+        prefilter_checks, prefilter_skips, line_cache_statistics = statistics
+        self.prefilter_checks.update(prefilter_checks)
+        self.prefilter_skips.update(prefilter_skips)
+        if self.line_cache is not None and line_cache_statistics is not None:
+            self.line_cache.add_statistics(line_cache_statistics)
 
-    with multiprocessing.Pool() as pool:
-        results = [pool.apply_async(parse_entity_type, (et, full_content)) for et in entity_types]
+    def prefilter_report(self):
+        skipped = sum(self.prefilter_skips.values())
+        checked = sum(self.prefilter_checks.values())
+        per_entity_type = ', '.join(f"{et.entity_type}: {self.prefilter_skips[et.entity_type_id]}/{self.prefilter_checks[et.entity_type_id]}"
+                                    for et in self.entity_types if self.prefilter_checks[et.entity_type_id])
+        return f"Literal prefilter skipped {skipped} of {checked} scans ({per_entity_type})"
 
-        for result in results:
+    def timeout_report(self):
+        # None if all entity types kept within their time budget
+        if not self.timeouts:
+            return None
+        entity_types = {et.entity_type_id: et for et in self.entity_types}
+        timeouts = ', '.join(f"{entity_types[entity_type_id].entity_type} ({entity_types[entity_type_id].regex_pattern or entity_types[entity_type_id].script_parser}) "
+                             f"on {source}: {count}x" for (entity_type_id, source), count in self.timeouts.items())
+        disabled = ', '.join(entity_types[entity_type_id].entity_type for entity_type_id in self.disabled_entity_type_ids)
+        return f"Parse time budget exceeded by {timeouts}" + (f"; stopped parsing {disabled}" if disabled else '')
+
+    def submit_tasks(self, content, entity_type_ids):
+        # Returns {task_id: (async result, entity_type_ids)}
+        tasks = {}
+        for entity_type_id in entity_type_ids:
+            self.submit_task(tasks, content, [entity_type_id])
+        return tasks
+
+    def submit_task(self, tasks, content, entity_type_ids):
+        if self.pool is None:
+            self.start_pool()
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        notify_finished = lambda _, task_id=task_id: self.finished_tasks.put(task_id)
+        tasks[task_id] = (self.pool.apply_async(parse_registered_entity_types, (entity_type_ids, content, task_id),
+                                                callback=notify_finished, error_callback=notify_finished), entity_type_ids)
+
+    def time_budget(self, content):
+        if isinstance(content, (MappedContentHandle, SharedContentHandle)):
+            size = content.end - content.start
+        else:
+            size = len(content)
+        return entity_type_time_budget(size)
+
+    def collect_results(self, content, abort_flag, entity_type_ids, source=None):
+        # Returns (matches, False if a task was given up, failed or the parse was aborted)
+        matches = []
+        complete = True
+        tasks = self.submit_tasks(content, entity_type_ids)
+        time_budget = self.time_budget(content)
+
+        while tasks:
+            # Wait with a timeout instead of blocking, so an abort or a task exceeding its time budget is noticed
             if abort_flag():
                 logging.debug("Aborting parsing due to flag")
-                break
+                return matches, False
+            try:
+                task_id = self.finished_tasks.get(timeout=0.1)
+            except queue.Empty:
+                if self.check_time_budgets(tasks, content, time_budget, source):
+                    complete = False
+                continue
+            if task_id not in tasks:
+                continue  # Of a task abandoned before (aborted, or its pool recycled)
+            result, _ = tasks.pop(task_id)
+            self.task_start_times.pop(task_id, None)
             try:
                 match_result = result.get()
                 #logging.debug(f"Match result: {match_result}")
                 matches.extend(match_result)
             except Exception as e:
                 logging.error(f"Error parsing entity type: {e}")
+                complete = False
+        return matches, complete
+
+    def check_time_budgets(self, tasks, content, time_budget, source):
+        # Tasks are timed from the moment a worker starts them. A task running longer than the budget of its entity
+        # types is given up: the pool is recycled and the other unfinished tasks are submitted again. Tasks of several
+        # entity types are retried with one task per entity type, to find the one which exceeds its budget.
+        # Returns True if the task of an entity type was given up.
+        now = time.monotonic()
+        while not self.task_starts.empty():
+            self.task_start_times[self.task_starts.get()] = now
+        exceeded = [task_id for task_id, (_, entity_type_ids) in tasks.items()
+                    if task_id in self.task_start_times and now - self.task_start_times[task_id] > time_budget * len(entity_type_ids)]
+        if not exceeded:
+            return False
+
+        given_up = False
+        retried = []
+        for task_id in exceeded:
+            _, entity_type_ids = tasks.pop(task_id)
+            if len(entity_type_ids) > 1:
+                retried.extend([entity_type_id] for entity_type_id in entity_type_ids)
+                continue
+            self.record_timeout(entity_type_ids[0], source, time_budget)
+            given_up = True
+
+        unfinished = [entity_type_ids for _, entity_type_ids in tasks.values()] + retried
+        tasks.clear()
+        self.recycle_pool()
+        for entity_type_ids in unfinished:
+            self.submit_task(tasks, content, entity_type_ids)
+        return given_up
+
+    def record_timeout(self, entity_type_id, source, time_budget):
+        self.timeouts[(entity_type_id, source)] += 1
+        entity_type = next(et for et in self.entity_types if et.entity_type_id == entity_type_id)
+        logging.warning(f"Parsing {entity_type.entity_type} exceeded its time budget of {time_budget:.0f}s on {source}, restarting its parser worker")
+        if entity_type_id in self.disabled_entity_type_ids:
+            return  # Timed out in a task started before it was disabled
+        if sum(count for (timed_out_id, _), count in self.timeouts.items() if timed_out_id == entity_type_id) >= MAX_ENTITY_TYPE_TIMEOUTS:
+            logging.warning(f"Not parsing {entity_type.entity_type} any more, it exceeded its time budget {MAX_ENTITY_TYPE_TIMEOUTS} times")
+            self.disabled_entity_type_ids.add(entity_type_id)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+def parse_content(full_content, abort_flag, db_session, parser_pool=None, source=None):
+    #logging.debug("Starting parsing content")
+    if parser_pool is None:
+        # No run-wide pool available, fall back to a pool for this single document
+        parser_pool = ParserPool(load_entity_type_specs(db_session))
+        try:
+            matches = parser_pool.parse(full_content, abort_flag, source)
+        finally:
+            parser_pool.terminate()
+    else:
+        matches = parser_pool.parse(full_content, abort_flag, source)
+
     for match in matches:
         if len(match) != 4:
             logging.error(f"Unexpected format for parsd entity: {match}")
@@ -1,9 +1,8 @@
 import logging
 import pdfplumber
-import re
-from datetime import datetime
 from logline_leviathan.file_processor.parser_thread import parse_content
-from logline_leviathan.file_processor.file_database_ops import handle_file_metadata, handle_individual_entity, handle_distinct_entity, handle_context_snippet
+from logline_leviathan.file_processor.line_index import LineIndex
+from logline_leviathan.file_processor.timestamp_index import TimestampIndex
 
 logging.getLogger('pdfminer').setLevel(logging.WARNING)
 
@@ -25,7 +24,8 @@ def process_pdf_file(file_path, file_mimetype, thread_instance, db_session, abor
             return 0
 
         entity_count = 0
-        file_metadata = handle_file_metadata(db_session, file_path, file_mimetype)
+        entity_writer = thread_instance.open_entity_writer(db_session, file_path, file_mimetype)
+        timestamp_format = None  # Detected on the first page with timestamps, then used for the whole file
 
         for page_number, content in enumerate(pages):
             if content is None:
@@ -33,61 +33,40 @@ def process_pdf_file(file_path, file_mimetype, thread_instance, db_session, abor
 
             if abort_flag():
                 logging.info("Processing aborted.")
+                entity_writer.discard()
                 return entity_count
             thread_instance.update_status.emit(f"   Processing now: {file_path}, page {page_number + 1}")
 
             # Call the new parser and get matches along with entity types
-            parsed_entities = parse_content(content, abort_flag, db_session)
-
-            for entity_type_id, match_text, start_pos, end_pos in parsed_entities:
+            parsed_entities = parse_content(content, abort_flag, db_session, thread_instance.parser_pool, file_path)
+
+            line_index = LineIndex(content)
+            timestamp_index = TimestampIndex(content, line_index, timestamp_format)
+            timestamp_format = timestamp_index.timestamp_format
+            start_lines, end_lines = line_index.match_lines(parsed_entities)
+            for (entity_type_id, match_text, start_pos, end_pos), match_start_line, match_end_line in zip(parsed_entities, start_lines, end_lines):
+                if abort_flag():
+                    break
                 if not match_text.strip():
                     continue
 
-                timestamp = find_timestamp_before_match(content, start_pos)
-                match_start_line, match_end_line = get_line_numbers_from_pos(content, start_pos, end_pos)
-
-                entity = handle_distinct_entity(db_session, match_text, entity_type_id)
-                individual_entity = handle_individual_entity(db_session, entity, file_metadata, match_start_line, timestamp, entity_type_id, abort_flag, thread_instance)
+                timestamp = timestamp_index.timestamp_for_line(match_start_line)
+                # PDF line numbers are counted from 1 within the page
+                match_start_line, match_end_line = match_start_line + 1, match_end_line + 1
 
-                if individual_entity:
-                    handle_context_snippet(db_session, individual_entity, [content], match_start_line, match_end_line)
+                if entity_writer.add(entity_type_id, match_text, match_start_line, match_end_line, timestamp, [content]):
                     entity_count += 1
 
+        if abort_flag():
+            entity_writer.discard()
+        else:
+            entity_writer.finish()
 
         logging.info(f"   Finished processing PDF file: {file_path}")
         return entity_count
     except Exception as e:
-        db_session.rollback()
+        if db_session is not None:
+            db_session.rollback()
         logging.error(f"Error processing PDF file {file_path}: {e}")
         return 0
 
-def get_line_numbers_from_pos(content, start_pos, end_pos):
-    start_line = content[:start_pos].count('\n') + 1
-    end_line = content[:end_pos].count('\n') + 1
-    return start_line, end_line
-
-def find_timestamp_before_match(content, match_start_pos):
-    search_content = content[:match_start_pos]
-    timestamp_patterns = [
-        (r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S'),  # ISO 8601 Extended
-        (r'\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}', '%Y/%m/%d %H:%M:%S'),  # ISO 8601 with slashes
-        (r'\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}', '%d/%m/%Y %H:%M:%S'),  # European Date Format
-        (r'\d{2}-\d{2}-\d{4} \d{2}:\d{2}:\d{2}', '%m-%d-%Y %H:%M:%S'),  # US Date Format
-        (r'\d{8}_\d{6}', '%Y%m%d_%H%M%S'),                             # Compact Format
-        (r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', '%Y-%m-%dT%H:%M:%S'),  # ISO 8601 Basic
-        (r'\d{2}\.\d{2}\.\d{4} \d{2}:\d{2}:\d{2}', '%d.%m.%Y %H:%M:%S'),# German Date Format
-        (r'\d{4}\d{2}\d{2} \d{2}:\d{2}:\d{2}', '%Y%m%d %H:%M:%S'),      # Basic Format without Separators
-        (r'\d{1,2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}:\d{2}', '%d-%b-%Y %H:%M:%S'), # English Date Format with Month Name
-        (r'(?:19|20)\d{10}', '%Y%m%d%H%M'),                             # Compact Numeric Format
-        # Add more patterns as needed
-    ]
-    for pattern, date_format in timestamp_patterns:
-        for timestamp_match in reversed(list(re.finditer(pattern, search_content))):
-            try:
-                # Convert the matched timestamp to the standardized format
-                matched_timestamp = datetime.strptime(timestamp_match.group(), date_format)
-                return matched_timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                continue  # If conversion fails, continue to the next pattern
-    return None
-
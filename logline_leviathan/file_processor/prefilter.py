@@ -0,0 +1,82 @@
+# Literal prefilter: for every entity type a set of strings of which every match contains at least one, taken from
+# its script parser (PREFILTER_LITERALS) or derived from its regex. Content containing none of them cannot have a
+# match, so the scan for that entity type is skipped.
+
+import re
+from re import _parser as sre_parse, _constants as sre_constants
+
+# Character classes with more members than this are not worth testing for
+MAX_CLASS_LITERALS = 4
+
+
+def required_literals(regex_pattern):
+    # A tuple of strings of which every match of the pattern contains at least one, None if none can be derived
+    try:
+        parsed = sre_parse.parse(regex_pattern)
+    except re.error:
+        return None
+    literals = sequence_literals(parsed, bool(parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE))
+    return tuple(sorted(literals)) if literals else None
+
+
+def sequence_literals(subpattern, ignore_case):
+    # Every item of a sequence has to match, so the most selective requirement of any item applies to the sequence.
+    # Runs of literal characters are joined into one string.
+    candidates = []
+    run = ''
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL and not (ignore_case and chr(av).lower() != chr(av).upper()):
+            run += chr(av)
+            continue
+        if run:
+            candidates.append({run})
+            run = ''
+        candidates.append(item_literals(op, av, ignore_case))
+    if run:
+        candidates.append({run})
+    return best_literals(candidates)
+
+
+def item_literals(op, av, ignore_case):
+    if op == sre_constants.SUBPATTERN:
+        group, add_flags, del_flags, subpattern = av
+        if add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+            ignore_case = True
+        elif del_flags & sre_constants.SRE_FLAG_IGNORECASE:
+            ignore_case = False
+        return sequence_literals(subpattern, ignore_case)
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, sre_constants.POSSESSIVE_REPEAT):
+        min_count, max_count, subpattern = av
+        return sequence_literals(subpattern, ignore_case) if min_count > 0 else None
+    if op == sre_constants.ATOMIC_GROUP:
+        return sequence_literals(av, ignore_case)
+    if op == sre_constants.BRANCH:
+        # Any branch may match, so all of their requirements are needed
+        literals = set()
+        for branch in av[1]:
+            branch_literals = sequence_literals(branch, ignore_case)
+            if not branch_literals:
+                return None
+            literals |= branch_literals
+        return literals
+    if op == sre_constants.IN and len(av) <= MAX_CLASS_LITERALS and all(member_op == sre_constants.LITERAL for member_op, _ in av):
+        chars = {chr(member_av) for _, member_av in av}
+        if ignore_case and any(char.lower() != char.upper() for char in chars):
+            return None
+        return chars
+    return None
+
+
+def best_literals(candidates):
+    # Longer literals are rarer, of equally long ones fewer alternatives are better
+    candidates = [literals for literals in candidates if literals]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda literals: (min(len(literal) for literal in literals), -len(literals)))
+
+
+def contains_any_literal(literals, content, start=0, end=None):
+    # content is a str, or the bytes of a pure ASCII file (memory-mapped), searched between start and end
+    if isinstance(content, str):
+        return any(literal in content for literal in literals)
+    return any(content.find(literal.encode('ascii'), start, end) >= 0 for literal in literals if literal.isascii())
@@ -0,0 +1,108 @@
+# Read-ahead: while a file (or a chunk of a large file) is parsed, a pool of I/O threads reads the files and chunks
+# which are processed next, so on network shares and spinning disks the disk works while the parser does. The data
+# read ahead is not kept by the read-ahead itself but by the operating system's file cache, which the processing reads
+# it back from: the processors map the files or read them by path, and so do the parser workers (see
+# MappedContentHandle). Keeping a copy would double the memory needed for it.
+# At most READ_AHEAD_MEMORY_BUDGET bytes of at most READ_AHEAD_MAX_FILES files are read ahead of the processing, so
+# the data read ahead is not dropped from the file cache again before it is processed.
+
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+READ_AHEAD_ENABLED = True
+# Per process reading files: the processing thread and every file ingestion worker
+READ_AHEAD_MEMORY_BUDGET = 64 * 1024 * 1024
+READ_AHEAD_MAX_FILES = 32
+READ_AHEAD_THREADS = 2
+# Large files are read ahead in blocks of this size, so the budget is given back as the processing moves on
+READ_AHEAD_BLOCK_SIZE = 4 * 1024 * 1024
+READ_AHEAD_BUFFER_SIZE = 1024 * 1024
+
+
+def read_block(file_path, start, end):
+    # Only brings the data into the file cache, it is dropped right away
+    try:
+        with open(file_path, 'rb', buffering=0) as file:
+            file.seek(start)
+            buffer = memoryview(bytearray(min(READ_AHEAD_BUFFER_SIZE, end - start)))
+            remaining = end - start
+            while remaining > 0:
+                read_size = file.readinto(buffer[:min(remaining, len(buffer))])
+                if not read_size:
+                    break
+                remaining -= read_size
+    except OSError as e:
+        logging.debug(f"Could not read ahead {file_path}: {e}")  # Reported when the file is processed
+
+
+class ReadAhead:
+    # Used by one thread, the one processing the files: it adds the files (or byte ranges of a file) in the order it
+    # processes them, reports how far it got in a file with consumed() and the end of a file with done()
+
+    def __init__(self, memory_budget=READ_AHEAD_MEMORY_BUDGET, max_files=READ_AHEAD_MAX_FILES, threads=READ_AHEAD_THREADS):
+        self.memory_budget = memory_budget
+        self.max_files = max_files
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='read_ahead')
+        self.queue = deque()     # [file_path, start, end] not read ahead yet, in processing order
+        self.blocks = {}         # {file_path: [(start, end)]} read ahead and not processed yet
+        self.positions = {}      # {file_path: position up to which the processing read the file}
+        self.buffered_size = 0   # Size of the blocks
+
+    def add_files(self, file_paths):
+        for file_path in file_paths:
+            try:
+                file_size = os.path.getsize(file_path)
+            except OSError:
+                continue
+            self.queue.append([file_path, 0, file_size])
+        self.fill()
+
+    def add_range(self, file_path, start, end):
+        self.queue.append([file_path, start, end])
+        self.fill()
+
+    def fill(self):
+        while self.queue and self.buffered_size < self.memory_budget:
+            queued_range = self.queue[0]
+            file_path, start, end = queued_range
+            if file_path not in self.blocks and len(self.blocks) >= self.max_files:
+                return
+            start = max(start, self.positions.get(file_path, 0))
+            block_end = min(end, start + READ_AHEAD_BLOCK_SIZE)
+            if block_end >= end:
+                self.queue.popleft()
+            else:
+                queued_range[1] = block_end
+            if start >= block_end:
+                continue  # The processing got there first
+            self.blocks.setdefault(file_path, []).append((start, block_end))
+            self.buffered_size += block_end - start
+            self.executor.submit(read_block, file_path, start, block_end)
+
+    def consumed(self, file_path, position):
+        # The processing read the file up to position, the blocks in front of it are not needed any more
+        self.positions[file_path] = max(position, self.positions.get(file_path, 0))
+        remaining_blocks = []
+        for start, end in self.blocks.get(file_path, ()):
+            if end <= position:
+                self.buffered_size -= end - start
+            else:
+                remaining_blocks.append((start, end))
+        if file_path in self.blocks:
+            self.blocks[file_path] = remaining_blocks
+        self.fill()
+
+    def done(self, file_path):
+        for start, end in self.blocks.pop(file_path, ()):
+            self.buffered_size -= end - start
+        self.positions.pop(file_path, None)
+        # A file can be done before it was read ahead completely (e.g. unsupported or aborted)
+        while self.queue and self.queue[0][0] == file_path:
+            self.queue.popleft()
+        self.fill()
+
+    def close(self):
+        self.queue.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
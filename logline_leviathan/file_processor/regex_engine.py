@@ -0,0 +1,102 @@
+# Regex engines for the regex patterns of the entity types and the patterns of script parsers, selected per entity
+# type with regex_engine in entities.yaml:
+#   re     Python's backtracking engine, the default
+#   regex  the third-party regex module (pip install regex), a backtracking engine supporting more syntax
+#   re2    a linear-time engine (pip install google-re2): no catastrophic backtracking on any input, but no
+#          backreferences, lookaround or possessive quantifiers; \d, \w and \b only match ASCII characters
+# An engine which is not installed or cannot compile a pattern falls back to the next one, re2 -> regex -> re.
+# All compiled patterns provide finditer(string, pos, endpos) with match objects offering group(), start(), end()
+# and span().
+
+import re
+import logging
+from re import _parser as sre_parse, _constants as sre_constants
+
+try:
+    import regex
+except ImportError:
+    regex = None
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+DEFAULT_REGEX_ENGINE = 're'
+REGEX_ENGINE_FALLBACKS = {'re2': 'regex', 'regex': 're', 're': None}
+# Flags RE2 supports as inline flags; it has no other ones
+RE2_INLINE_FLAGS = {re.IGNORECASE: 'i', re.MULTILINE: 'm', re.DOTALL: 's'}
+
+# Per-process cache of compiled patterns: {(pattern, engine, flags): compiled pattern}
+_compiled_patterns = {}
+# Character classes which match differently as bytes than as str even on ASCII content: as str, \s and \S also
+# count the separators \x1c-\x1f as whitespace, as bytes they do not
+BYTES_DIFFERING_CATEGORIES = (sre_constants.CATEGORY_SPACE, sre_constants.CATEGORY_NOT_SPACE)
+
+
+def regex_engine_module(engine):
+    return {'re': re, 'regex': regex, 're2': re2}.get(engine)
+
+
+def uses_categories(items, categories):
+    for item in items:
+        if isinstance(item, tuple) and len(item) == 2 and item[0] is sre_constants.CATEGORY:
+            if any(item[1] is category for category in categories):
+                return True
+        elif isinstance(item, (tuple, list, sre_parse.SubPattern)) and uses_categories(item, categories):
+            return True
+    return False
+
+
+def matches_alike_as_bytes(pattern):
+    # Whether the str pattern, compiled as bytes, finds the same matches on ASCII content. Patterns which re cannot
+    # parse (e.g. syntax of the regex module only) are not considered alike.
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, TypeError):
+        return False
+    return not uses_categories(parsed, BYTES_DIFFERING_CATEGORIES)
+
+
+def compile_re2_pattern(pattern, flags):
+    inline_flags = ''
+    for flag, inline_flag in RE2_INLINE_FLAGS.items():
+        if flags & flag:
+            inline_flags += inline_flag
+            flags &= ~flag
+    if flags & ~re.UNICODE:
+        raise ValueError(f"flags {flags} are not supported by re2")
+    if inline_flags:
+        prefix = f'(?{inline_flags})'
+        pattern = (prefix.encode('ascii') if isinstance(pattern, bytes) else prefix) + pattern
+    return re2.compile(pattern)
+
+
+def compile_pattern(pattern, engine=None, flags=0):
+    # pattern may be str or bytes; raises re.error if not even re can compile it
+    key = (pattern, engine, flags)
+    try:
+        return _compiled_patterns[key]
+    except KeyError:
+        pass
+
+    requested_engine = engine or DEFAULT_REGEX_ENGINE
+    if requested_engine not in REGEX_ENGINE_FALLBACKS:
+        logging.error(f"Unknown regex engine {requested_engine}, using {DEFAULT_REGEX_ENGINE}")
+        requested_engine = DEFAULT_REGEX_ENGINE
+    engine = requested_engine
+    while engine != DEFAULT_REGEX_ENGINE:
+        engine_module = regex_engine_module(engine)
+        if engine_module is None:
+            logging.warning(f"Regex engine {engine} is not installed, falling back to {REGEX_ENGINE_FALLBACKS[engine]}")
+        else:
+            try:
+                compiled_pattern = compile_re2_pattern(pattern, flags) if engine == 're2' else engine_module.compile(pattern, flags)
+                break
+            except Exception as e:  # Every engine has its own error type
+                logging.debug(f"Regex engine {engine} cannot compile {pattern!r}, falling back to {REGEX_ENGINE_FALLBACKS[engine]}: {e}")
+        engine = REGEX_ENGINE_FALLBACKS[engine]
+    else:
+        compiled_pattern = re.compile(pattern, flags)
+
+    _compiled_patterns[key] = compiled_pattern
+    return compiled_pattern
@@ -0,0 +1,113 @@
+# Hands a document to the parser workers through shared memory: the content is encoded into one shared memory block
+# per document and the workers only receive a small handle (block name plus byte offsets) instead of a pickled copy
+# of the content for every entity type. Text files which can be scanned as bytes are not copied at all, the workers
+# map the file into memory themselves and receive a handle with its path instead.
+
+import os
+import mmap
+import logging
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
+
+# Documents smaller than this are cheaper to pickle than to place into shared memory
+SHARED_CONTENT_MIN_SIZE = 64 * 1024
+
+SharedContentHandle = namedtuple('SharedContentHandle', ['name', 'start', 'end'])
+# Byte range of a memory-mapped ASCII text file
+MappedContentHandle = namedtuple('MappedContentHandle', ['path', 'start', 'end'])
+
+# Worker-side cache of the last decoded document, so all entity types of one document handled by the same
+# worker share a single decoded copy
+_attached_content = (None, None)
+# Worker-side mapping of the file last referenced by a MappedContentHandle, as (path, mmap)
+_mapped_file = (None, None)
+
+
+def share_content(full_content):
+    # Returns (shared_memory_block, handle); the caller owns the block and has to release it when parsing is done
+    data = full_content.encode('utf-8')
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    return shm, SharedContentHandle(shm.name, 0, len(data))
+
+
+def release_shared_content(shm):
+    try:
+        shm.close()
+        shm.unlink()
+    except Exception as e:
+        logging.error(f"Error releasing shared content {shm.name}: {e}")
+
+
+def ensure_shared_content_tracking():
+    # Has to run before the parser workers are started: forked workers then share the resource tracker of this
+    # process instead of starting their own one, which would unlink the blocks they attached to when they exit.
+    # The resource tracker only exists on POSIX, Windows frees a block once its last handle is closed.
+    if os.name == 'posix':
+        resource_tracker.ensure_running()
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # track is only available from Python 3.13 on
+        return shared_memory.SharedMemory(name=name)
+
+
+def read_shared_content(handle):
+    global _attached_content
+    if _attached_content[0] == handle:
+        return _attached_content[1]
+
+    _attached_content = (None, None)  # Drop the previous document before decoding the next one
+    shm = attach_shared_memory(handle.name)
+    try:
+        with shm.buf[handle.start:handle.end] as view:
+            content = str(view, 'utf-8')
+    finally:
+        shm.close()
+    _attached_content = (handle, content)
+    return content
+
+
+def map_content_file(path):
+    global _mapped_file
+    if _mapped_file[0] == path:
+        return _mapped_file[1]
+
+    if _mapped_file[1] is not None:
+        _mapped_file[1].close()
+    _mapped_file = (None, None)
+    with open(path, 'rb') as file:
+        mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    _mapped_file = (path, mapped_file)
+    return mapped_file
+
+
+def read_mapped_content(handle):
+    # Decoded copy of a mapped byte range, for parsers which need str content
+    global _attached_content
+    if _attached_content[0] == handle:
+        return _attached_content[1]
+
+    _attached_content = (None, None)
+    content = map_content_file(handle.path)[handle.start:handle.end].decode('ascii')
+    _attached_content = (handle, content)
+    return content
+
+
+def read_mapped_range(handle):
+    # Decoded copy of the byte range of a MappedContentHandle, read from the file without mapping it
+    with open(handle.path, 'rb') as file:
+        file.seek(handle.start)
+        return file.read(handle.end - handle.start).decode('ascii')
+
+
+def resolve_content(content):
+    # Parse tasks receive either the content itself (small documents), a handle to shared memory or a handle to a
+    # memory-mapped file
+    if isinstance(content, SharedContentHandle):
+        return read_shared_content(content)
+    if isinstance(content, MappedContentHandle):
+        return read_mapped_content(content)
+    return content
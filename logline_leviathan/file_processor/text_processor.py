@@ -1,89 +1,303 @@
+import io
+import os
 import re
+import mmap
 import logging
+from collections import namedtuple
 from logline_leviathan.file_processor.parser_thread import parse_content
-from datetime import datetime
-from logline_leviathan.file_processor.file_database_ops import handle_file_metadata, handle_individual_entity, handle_context_snippet, handle_distinct_entity
+from logline_leviathan.file_processor.file_database_ops import MAX_CONTEXT_LINES
+from logline_leviathan.file_processor.line_index import LineIndex, EncodedLines
+from logline_leviathan.file_processor.timestamp_index import TimestampIndex, detect_timestamp_format
+from logline_leviathan.file_processor.shared_content import MappedContentHandle
 
-def read_file_content(file_path):
+# Text files are read and parsed in line-aligned chunks of about this many characters, which bounds peak memory;
+# smaller files are processed as a single chunk
+TEXT_CHUNK_SIZE = 8 * 1024 * 1024
+# Characters read beyond the end of a chunk, so matches crossing the chunk border are still found completely.
+# Has to be larger than the longest expected entity.
+TEXT_CHUNK_OVERLAP = 64 * 1024
+# Scan pure ASCII text files as bytes straight from a memory mapping instead of decoding them first
+TEXT_MMAP_SCANNING = True
+# Files containing any of these are decoded: byte offsets would not be character offsets, and text mode reading
+# translates carriage returns
+NOT_MAPPABLE_BYTES = re.compile(rb'[\x80-\xff\r]')
+# Bytes in front of a segment searched for the timestamp its first lines inherit, and read from the start of the file
+# to detect the timestamp format (see TextSegment)
+SEGMENT_TIMESTAMP_LOOKBACK = 16 * 1024 * 1024
+SEGMENT_FORMAT_DETECTION_SIZE = 1024 * 1024
+# How all text files are decoded, whether read sequentially, in segments or memory-mapped (those are pure ASCII):
+# bytes which are not valid UTF-8 become U+FFFD instead of failing the file
+TEXT_ENCODING = 'utf-8'
+TEXT_DECODING_ERRORS = 'replace'
+
+# One chunk of a text file: the window of lines around it (see iter_text_chunks), the content to build the line and
+# timestamp index from (str, or bytes when scanning a mapped file), the length of the part of that content owned by
+# this chunk, what is handed to the parser (the content itself or a MappedContentHandle) and the byte offset up to
+# which the file was read for the chunk
+TextChunk = namedtuple('TextChunk', ['lines', 'first_line', 'owned_start', 'owned_end', 'content', 'owned_length', 'parse_input', 'read_end'])
+
+# Large text files are split into segments, which are processed independently (in parallel, see file_ingestion.py):
+# line-aligned byte ranges [start, end) of the file, whose first line has the line number first_line. line_count is
+# the number of lines of the segment (None for the last one), mappable whether the whole file can be scanned as bytes
+# (see map_ascii_text_file). Matches and their context are the same as when the file is processed as a whole; the
+# timestamp format is the one detected at the start of the file.
+TextSegment = namedtuple('TextSegment', ['start', 'end', 'first_line', 'line_count', 'mappable'])
+
+
+def count_line_breaks(data):
+    # Line breaks as text mode reading sees them: '\n', '\r\n' and a lone '\r' each end a line
+    return data.count(b'\n') + data.count(b'\r') - data.count(b'\r\n')
+
+
+def open_text(binary_file):
+    # Text mode reading of a file opened in binary mode, line breaks translated to '\n'
+    return io.TextIOWrapper(binary_file, encoding=TEXT_ENCODING, errors=TEXT_DECODING_ERRORS)
+
+
+def decode_text(data):
+    # Decodes bytes of a text file the way open_text reads them
+    return data.decode(TEXT_ENCODING, errors=TEXT_DECODING_ERRORS).replace('\r\n', '\n').replace('\r', '\n')
+
+
+def plan_text_segments(file_path, segment_size):
+    # Cuts the file into segments of about segment_size bytes at line starts, counting the lines in one pass
+    with open(file_path, 'rb') as file:
+        file_size = os.fstat(file.fileno()).st_size
+        if file_size == 0:
+            return [TextSegment(0, 0, 0, None, False)]
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            mappable = TEXT_MMAP_SCANNING and not NOT_MAPPABLE_BYTES.search(mapped_file)
+            segments = []
+            start = 0
+            first_line = 0
+            while start < file_size:
+                end = next_line_start(mapped_file, start + segment_size - 1)
+                if end >= file_size:
+                    segments.append(TextSegment(start, file_size, first_line, None, mappable))
+                    break
+                line_count = count_line_breaks(mapped_file[start:end])
+                segments.append(TextSegment(start, end, first_line, line_count, mappable))
+                first_line += line_count
+                start = end
+    return segments
+
+
+def read_lines_before(file, position, count):
+    # The last count lines in front of position (a line start) of a file opened in binary mode
+    if count <= 0 or position == 0:
+        return []
+    start = position
+    data = b''
+    while start > 0 and data.count(b'\n') <= count:
+        block_start = max(0, start - 64 * 1024)
+        file.seek(block_start)
+        data = file.read(start - block_start) + data
+        start = block_start
+    if start > 0:
+        data = data[data.find(b'\n') + 1:]  # Drop the incomplete first line
+    return open_text(io.BytesIO(data)).readlines()[-count:]
+
+
+def segment_timestamp_context(file_path, segment):
+    # (timestamp format, timestamp) for a segment: the format detected at the start of the file and the most recent
+    # timestamp in front of the segment, which its lines before the first timestamp of their own inherit
+    if segment.start == 0:
+        return None, None
+    with open(file_path, 'rb') as file:
+        head = file.read(min(segment.start, SEGMENT_FORMAT_DETECTION_SIZE))
+        head_content = decode_text(head[:head.rfind(b'\n') + 1] or head)
+        timestamp_format = detect_timestamp_format(head_content, LineIndex(head_content))
+
+        block_end = segment.start
+        lookback_start = max(0, segment.start - SEGMENT_TIMESTAMP_LOOKBACK)
+        while block_end > lookback_start:
+            block_start = max(lookback_start, block_end - TEXT_CHUNK_SIZE)
+            file.seek(block_start)
+            data = file.read(block_end - block_start)
+            if block_start > 0:
+                line_start = data.find(b'\n') + 1
+                if line_start > 0:
+                    data = data[line_start:]
+                    block_start += line_start
+            content = decode_text(data)
+            line_index = LineIndex(content)
+            timestamp = TimestampIndex(content, line_index, timestamp_format).timestamp_for_line(len(line_index.newline_positions))
+            if timestamp is not None:
+                return timestamp_format, timestamp
+            block_end = block_start
+    return timestamp_format, None
+
+
+def iter_text_chunks(file_path, chunk_size=TEXT_CHUNK_SIZE, overlap=TEXT_CHUNK_OVERLAP, context_lines=MAX_CONTEXT_LINES, segment=None):
+    # Yields TextChunks with lines, first_line, owned_start and owned_end: a window of lines of the file whose first line has the line
+    # number first_line. Matches are taken from the lines[owned_start:owned_end], the lines in front of it and the
+    # lookahead behind it (at least `overlap` characters and `context_lines` lines) provide context and complete
+    # matches crossing the chunk border. The lookahead becomes part of the next chunk.
+    # With a segment, only its lines are owned; the context and lookahead extend beyond it.
+    with open(file_path, 'rb') as binary_file:
+        window = []
+        first_line = 0
+        owned_start = 0
+        lines_left = None  # Lines of the segment not owned by a chunk yet
+        if segment is not None:
+            window = read_lines_before(binary_file, segment.start, context_lines)
+            first_line = segment.first_line - len(window)
+            owned_start = len(window)
+            lines_left = segment.line_count
+            binary_file.seek(segment.start)
+        file = open_text(binary_file)
+
+        def extend_window(index):
+            # Makes sure window[index] exists, returns False at the end of the file
+            if index < len(window):
+                return True
+            line = file.readline()
+            if not line:
+                return False
+            window.append(line)
+            return True
+
+        while True:
+            owned_end = owned_start
+            owned_size = 0
+            while owned_size < chunk_size and (lines_left is None or owned_end - owned_start < lines_left) and extend_window(owned_end):
+                owned_size += len(window[owned_end])
+                owned_end += 1
+            if owned_end == owned_start:
+                return
+            if lines_left is not None:
+                lines_left -= owned_end - owned_start
+
+            lookahead_end = owned_end
+            lookahead_size = 0
+            while (lookahead_size < overlap or lookahead_end - owned_end < context_lines) and extend_window(lookahead_end):
+                lookahead_size += len(window[lookahead_end])
+                lookahead_end += 1
+
+            chunk_content = ''.join(window[owned_start:lookahead_end])
+            owned_length = sum(len(line) for line in window[owned_start:owned_end])
+            yield TextChunk(window, first_line, owned_start, owned_end, chunk_content, owned_length, chunk_content, binary_file.tell())
+
+            # Keep the lines the next chunk needs as context in front of it
+            keep_from = max(0, owned_end - context_lines)
+            window = window[keep_from:]
+            first_line += keep_from
+            owned_start = owned_end - keep_from
+
+
+def map_ascii_text_file(file_path, known_mappable=False):
+    # Memory-maps the file for bytes level scanning, None if it has to be decoded (or mmap scanning is disabled).
+    # known_mappable skips the scan of the file, for segments (see plan_text_segments).
+    if not TEXT_MMAP_SCANNING:
+        return None
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return file.readlines()
-    except Exception as e:
-        logging.error(f"Error reading file {file_path}: {e}")
+        with open(file_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return None
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not map {file_path}, decoding it instead: {e}")
         return None
+    if not known_mappable and NOT_MAPPABLE_BYTES.search(mapped_file):
+        mapped_file.close()
+        return None
+    return mapped_file
+
+
+def next_line_start(mapped_file, position):
+    # Start of the line following the one containing position
+    if position >= len(mapped_file):
+        return len(mapped_file)
+    newline_position = mapped_file.find(b'\n', position)
+    return len(mapped_file) if newline_position < 0 else newline_position + 1
+
+
+def iter_mapped_text_chunks(file_path, mapped_file, chunk_size=TEXT_CHUNK_SIZE, overlap=TEXT_CHUNK_OVERLAP, context_lines=MAX_CONTEXT_LINES, segment=None):
+    # Same chunks as iter_text_chunks, but cut from a memory-mapped ASCII file by byte offsets. Only the line window
+    # is copied out of the mapping (for the line and timestamp index, and the context lines which are decoded on
+    # demand); the parser workers scan the mapping themselves.
+    chunk_start, end, chunk_first_line = (segment.start, segment.end, segment.first_line) if segment is not None else (0, len(mapped_file), 0)
+    while chunk_start < end:
+        chunk_end = min(next_line_start(mapped_file, chunk_start + chunk_size - 1), end)
+        scan_end = chunk_end
+        for _ in range(context_lines):
+            scan_end = next_line_start(mapped_file, scan_end)
+        scan_end = max(scan_end, next_line_start(mapped_file, chunk_end + overlap - 1))
 
+        window_start = chunk_start
+        owned_start = 0
+        while owned_start < context_lines and window_start > 0:
+            window_start = mapped_file.rfind(b'\n', 0, window_start - 1) + 1
+            owned_start += 1
 
-def process_text_file(file_path, file_mimetype, thread_instance, db_session, abort_flag):
+        window = mapped_file[window_start:scan_end]
+        lines = EncodedLines(window)
+        owned_end = lines.line_starts.index(chunk_end - window_start) if chunk_end < scan_end else len(lines)
+        yield TextChunk(lines, chunk_first_line - owned_start, owned_start, owned_end,
+                        memoryview(window)[chunk_start - window_start:], chunk_end - chunk_start,
+                        MappedContentHandle(file_path, chunk_start, scan_end), scan_end)
+
+        chunk_first_line += owned_end - owned_start
+        chunk_start = chunk_end
+
+
+def process_text_file(file_path, file_mimetype, thread_instance, db_session, abort_flag, segment=None):
+    # With a segment (see TextSegment) only that part of the file is processed
     try:
         #logging.info(f"Starting processing of text file: {file_path}")
-        file_metadata = handle_file_metadata(db_session, file_path, file_mimetype)
-        content = read_file_content(file_path)
-        full_content = ''.join(content)  # Join all lines into a single string
+        entity_writer = thread_instance.open_entity_writer(db_session, file_path, file_mimetype)
         thread_instance.update_status.emit(f"   Processing now: {file_path}")
 
-        # Call the new parser and get matches along with entity types
-        parsed_entities = parse_content(full_content, abort_flag, db_session)
-
         entity_count = 0
-        for entity_type_id, match_text, start_pos, end_pos in parsed_entities:
-            if not match_text.strip():
-                continue
+        timestamp_format = None  # Detected on the first chunk, then used for the whole file
+        previous_timestamp = None  # Most recent timestamp of the chunks before, for lines in front of the first one of a chunk
+        if segment is not None:
+            timestamp_format, previous_timestamp = segment_timestamp_context(file_path, segment)
+            mapped_file = map_ascii_text_file(file_path, known_mappable=True) if segment.mappable else None
+        else:
+            mapped_file = map_ascii_text_file(file_path)
+        try:
+            if mapped_file is not None:
+                chunks = iter_mapped_text_chunks(file_path, mapped_file, TEXT_CHUNK_SIZE, TEXT_CHUNK_OVERLAP, segment=segment)
+            else:
+                chunks = iter_text_chunks(file_path, TEXT_CHUNK_SIZE, TEXT_CHUNK_OVERLAP, segment=segment)
+            for chunk in chunks:
+                if abort_flag():
+                    break
+
+                # Call the new parser and get matches along with entity types; matches starting in the lookahead belong to the next chunk
+                parsed_entities = [match for match in parse_content(chunk.parse_input, abort_flag, db_session, thread_instance.parser_pool, file_path) if match[2] < chunk.owned_length]
 
-            timestamp = find_timestamp_before_match(full_content, start_pos)
-            match_start_line, match_end_line = get_line_numbers_from_pos(content, start_pos, end_pos)
+                line_index = LineIndex(chunk.content)
+                timestamp_index = TimestampIndex(chunk.content, line_index, timestamp_format)
+                timestamp_format = timestamp_index.timestamp_format
+                chunk_first_line = chunk.first_line + chunk.owned_start
+                start_lines, end_lines = line_index.match_lines(parsed_entities)
+                for (entity_type_id, match_text, start_pos, end_pos), match_start_line, match_end_line in zip(parsed_entities, start_lines, end_lines):
+                    if abort_flag():
+                        break
+                    if not match_text.strip():
+                        continue
 
-            entity = handle_distinct_entity(db_session, match_text, entity_type_id)
-            individual_entity = handle_individual_entity(db_session, entity, file_metadata, match_start_line, timestamp, entity_type_id, abort_flag, thread_instance)
-                
-            if individual_entity:
-                entity_count += 1
-                handle_context_snippet(db_session, individual_entity, content, match_start_line, match_end_line)
+                    timestamp = timestamp_index.timestamp_for_line(match_start_line) or previous_timestamp
 
+                    if entity_writer.add(entity_type_id, match_text, chunk_first_line + match_start_line, chunk_first_line + match_end_line, timestamp, chunk.lines, chunk.first_line):
+                        entity_count += 1
+
+                previous_timestamp = timestamp_index.timestamp_for_line(chunk.owned_end - chunk.owned_start - 1) or previous_timestamp
+                if thread_instance.read_ahead is not None:
+                    thread_instance.read_ahead.consumed(file_path, chunk.read_end)
+        finally:
+            if mapped_file is not None:
+                mapped_file.close()
+
+        if abort_flag():
+            entity_writer.discard()
+        else:
+            entity_writer.finish()
         return entity_count
     except Exception as e:
-        db_session.rollback()
+        if db_session is not None:
+            db_session.rollback()
         logging.error(f"Error processing text file {file_path}: {e}")
         return 0
-
-
-def get_line_numbers_from_pos(content, start_pos, end_pos):
-    start_line = end_line = 0
-    current_pos = 0
-    for i, line in enumerate(content):
-        current_pos += len(line)
-        if start_pos < current_pos:
-            start_line = i
-            break
-    for i, line in enumerate(content[start_line:], start=start_line):
-        current_pos += len(line)
-        if end_pos <= current_pos:
-            end_line = i
-            break
-    return start_line, end_line
-
-
-def find_timestamp_before_match(content, match_start_pos):
-    search_content = content[:match_start_pos]
-    timestamp_patterns = [
-        (r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S'),  # ISO 8601 Extended
-        (r'\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}', '%Y/%m/%d %H:%M:%S'),  # ISO 8601 with slashes
-        (r'\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}', '%d/%m/%Y %H:%M:%S'),  # European Date Format
-        (r'\d{2}-\d{2}-\d{4} \d{2}:\d{2}:\d{2}', '%m-%d-%Y %H:%M:%S'),  # US Date Format
-        (r'\d{8}_\d{6}', '%Y%m%d_%H%M%S'),                             # Compact Format
-        (r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', '%Y-%m-%dT%H:%M:%S'),  # ISO 8601 Basic
-        (r'\d{2}\.\d{2}\.\d{4} \d{2}:\d{2}:\d{2}', '%d.%m.%Y %H:%M:%S'),# German Date Format
-        (r'\d{4}\d{2}\d{2} \d{2}:\d{2}:\d{2}', '%Y%m%d %H:%M:%S'),      # Basic Format without Separators
-        (r'\d{1,2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}:\d{2}', '%d-%b-%Y %H:%M:%S'), # English Date Format with Month Name
-        (r'(?:19|20)\d{10}', '%Y%m%d%H%M'),                             # Compact Numeric Format
-        # Add more patterns as needed
-    ]
-    for pattern, date_format in timestamp_patterns:
-        for timestamp_match in reversed(list(re.finditer(pattern, search_content))):
-            try:
-                # Convert the matched timestamp to the standardized format
-                matched_timestamp = datetime.strptime(timestamp_match.group(), date_format)
-                return matched_timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                continue  # If conversion fails, continue to the next pattern
-    return None
-
@@ -0,0 +1,167 @@
+import re
+import numpy as np
+from datetime import datetime
+
+
+# Number of lines at the start of a document used to detect its dominant timestamp format
+FORMAT_DETECTION_LINES = 200
+# Bounds the memo of parsed timestamp strings kept per format
+PARSED_TIMESTAMP_CACHE_SIZE = 100000
+
+# Width of the fixed-width numeric fields which can be parsed by slicing instead of strptime
+FIXED_WIDTH_FIELDS = {'%Y': 4, '%m': 2, '%d': 2, '%H': 2, '%M': 2, '%S': 2}
+DATETIME_FIELDS = ['%Y', '%m', '%d', '%H', '%M', '%S']
+
+
+def compile_field_slices(date_format):
+    # '%Y-%m-%d %H:%M:%S' -> [(0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19)], in datetime() argument order.
+    # Returns None for formats with variable width fields (e.g. month names), which are left to strptime.
+    field_slices = {}
+    position = 0
+    i = 0
+    while i < len(date_format):
+        directive = date_format[i:i + 2]
+        if directive.startswith('%'):
+            if directive not in FIXED_WIDTH_FIELDS:
+                return None
+            field_slices[directive] = (position, position + FIXED_WIDTH_FIELDS[directive])
+            position += FIXED_WIDTH_FIELDS[directive]
+            i += 2
+        else:
+            position += 1
+            i += 1
+    if any(field not in field_slices for field in DATETIME_FIELDS[:5]):
+        return None
+    return [field_slices[field] for field in DATETIME_FIELDS if field in field_slices]
+
+
+class TimestampFormat:
+    # One supported timestamp format: its regex and a parser specialized for it, memoized per timestamp string
+
+    def __init__(self, pattern, date_format):
+        self.pattern = re.compile(pattern)
+        self.bytes_pattern = re.compile(pattern.encode('ascii'))
+        self.date_format = date_format
+        self.field_slices = compile_field_slices(date_format)
+        self.parsed_timestamps = {}
+
+    def parse(self, timestamp_text):
+        try:
+            return self.parsed_timestamps[timestamp_text]
+        except KeyError:
+            pass
+        try:
+            if self.field_slices:
+                timestamp = datetime(*[int(timestamp_text[start:end]) for start, end in self.field_slices])
+            else:
+                timestamp = datetime.strptime(timestamp_text, self.date_format)
+        except ValueError:
+            timestamp = None  # Looks like a timestamp, but is not a valid date
+        if len(self.parsed_timestamps) >= PARSED_TIMESTAMP_CACHE_SIZE:
+            self.parsed_timestamps.clear()
+        self.parsed_timestamps[timestamp_text] = timestamp
+        return timestamp
+
+    def find_timestamps(self, content, start=0, end=None):
+        # Yields (position, timestamp) for the valid timestamps in str or ASCII bytes content, between start and end
+        pattern = self.pattern if isinstance(content, str) else self.bytes_pattern
+        for timestamp_match in pattern.finditer(content, start, len(content) if end is None else end):
+            timestamp_text = timestamp_match.group()
+            timestamp = self.parse(timestamp_text if isinstance(timestamp_text, str) else timestamp_text.decode('ascii'))
+            if timestamp is not None:
+                yield timestamp_match.start(), timestamp
+
+
+# Supported timestamp formats, in order of preference when a line contains more than one of them
+TIMESTAMP_FORMATS = [
+    TimestampFormat(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S'),  # ISO 8601 Extended
+    TimestampFormat(r'\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}', '%Y/%m/%d %H:%M:%S'),  # ISO 8601 with slashes
+    TimestampFormat(r'\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}', '%d/%m/%Y %H:%M:%S'),  # European Date Format
+    TimestampFormat(r'\d{2}-\d{2}-\d{4} \d{2}:\d{2}:\d{2}', '%m-%d-%Y %H:%M:%S'),  # US Date Format
+    TimestampFormat(r'\d{8}_\d{6}', '%Y%m%d_%H%M%S'),                             # Compact Format
+    TimestampFormat(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', '%Y-%m-%dT%H:%M:%S'),  # ISO 8601 Basic
+    TimestampFormat(r'\d{2}\.\d{2}\.\d{4} \d{2}:\d{2}:\d{2}', '%d.%m.%Y %H:%M:%S'),# German Date Format
+    TimestampFormat(r'\d{4}\d{2}\d{2} \d{2}:\d{2}:\d{2}', '%Y%m%d %H:%M:%S'),      # Basic Format without Separators
+    TimestampFormat(r'\d{1,2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}:\d{2}', '%d-%b-%Y %H:%M:%S'), # English Date Format with Month Name
+    TimestampFormat(r'(?:19|20)\d{10}', '%Y%m%d%H%M'),                             # Compact Numeric Format
+    # Add more patterns as needed
+]
+
+
+def detect_timestamp_format(content, line_index):
+    # The format with the most valid timestamps in the first lines of the document, None if there are none
+    if len(line_index.newline_positions) > FORMAT_DETECTION_LINES:
+        sample = content[:int(line_index.newline_positions[FORMAT_DETECTION_LINES])]
+    else:
+        sample = content
+    best_format = None
+    best_count = 0
+    for timestamp_format in TIMESTAMP_FORMATS:
+        count = sum(1 for _ in timestamp_format.find_timestamps(sample))
+        if count > best_count:
+            best_format, best_count = timestamp_format, count
+    return best_format
+
+
+class TimestampIndex:
+    # Built in one forward scan over a document: records for every line the timestamp found on that line or, if the
+    # line has none, the most recent one on a line before it. Matches then look up their timestamp by line number.
+    # The dominant format of the document is scanned for first, over the whole document; only the lines without a
+    # timestamp in it are searched for all formats, so lines in other formats still get their own timestamp.
+
+    def __init__(self, content, line_index, timestamp_format=None):
+        self.timestamp_format = timestamp_format or detect_timestamp_format(content, line_index)
+        line_count = len(line_index.newline_positions) + 1
+
+        self.timestamps = []
+        positions = []
+        priorities = []
+
+        def add_timestamps(timestamp_format, priority, start=0, end=None):
+            for position, matched_timestamp in timestamp_format.find_timestamps(content, start, end):
+                self.timestamps.append(matched_timestamp)
+                positions.append(position)
+                priorities.append(priority)
+
+        if self.timestamp_format is None:
+            for priority, timestamp_format in enumerate(TIMESTAMP_FORMATS):
+                add_timestamps(timestamp_format, priority)
+        else:
+            add_timestamps(self.timestamp_format, -1)  # Preferred over the other formats on the same line
+            missing = np.ones(line_count, dtype=bool)
+            missing[line_index.line_numbers(positions)] = False
+            for start, end in self.line_ranges(missing, line_index.newline_positions, len(content)):
+                for priority, timestamp_format in enumerate(TIMESTAMP_FORMATS):
+                    if timestamp_format is not self.timestamp_format:
+                        add_timestamps(timestamp_format, priority, start, end)
+
+        self.line_timestamps = np.full(line_count, -1, dtype=np.int64)
+        if not self.timestamps:
+            return
+
+        positions = np.asarray(positions, dtype=np.int64)
+        lines = line_index.line_numbers(positions)
+        # Per line, the preferred format wins; of several timestamps in that format, the last one on the line
+        order = np.lexsort((-positions, np.asarray(priorities), lines))
+        first_of_line = np.ones(len(order), dtype=bool)
+        first_of_line[1:] = lines[order][1:] != lines[order][:-1]
+        chosen = order[first_of_line]
+        self.line_timestamps[lines[chosen]] = chosen
+
+        # Lines without a timestamp of their own inherit the one of the closest line above
+        has_timestamp = self.line_timestamps >= 0
+        last_line_with_timestamp = np.maximum.accumulate(np.where(has_timestamp, np.arange(line_count), 0))
+        self.line_timestamps = np.where(has_timestamp[last_line_with_timestamp], self.line_timestamps[last_line_with_timestamp], -1)
+
+    @staticmethod
+    def line_ranges(selected, newline_positions, content_length):
+        # (start, end) character ranges of the runs of consecutive selected lines
+        flags = np.concatenate(([False], selected, [False]))
+        changes = np.flatnonzero(flags[1:] != flags[:-1])
+        line_starts = np.concatenate(([0], newline_positions + 1))
+        line_ends = np.concatenate((newline_positions, [content_length]))
+        return [(int(line_starts[first]), int(line_ends[last - 1])) for first, last in zip(changes[::2], changes[1::2])]
+
+    def timestamp_for_line(self, line_number):
+        timestamp_id = self.line_timestamps[line_number]
+        return self.timestamps[timestamp_id] if timestamp_id >= 0 else None
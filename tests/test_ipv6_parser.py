@@ -0,0 +1,34 @@
+import random
+from data.parser import ipv6
+
+
+def hex_digits(count):
+    return ''.join(random.choice('0123456789abcdef') for _ in range(count))
+
+
+def test_finds_only_the_addresses_in_a_hex_heavy_log():
+    # Hashes, GUIDs, MAC addresses and hex dumps surround the addresses; none of them may be taken for one
+    random.seed(0)
+    lines = []
+    expected = []
+    for i in range(200):
+        source = f"2001:db8:{hex_digits(4)}::{hex_digits(3)}"
+        destination = f"fe80::{hex_digits(4)}%eth0"
+        lines.append(f"2024-01-01 12:{i % 60:02d}:{i % 60:02d} sha256={hex_digits(64)} "
+                     f"guid={hex_digits(8)}-{hex_digits(4)}-{hex_digits(4)}-{hex_digits(4)}-{hex_digits(12)} "
+                     f"mac={':'.join(hex_digits(2) for _ in range(6))} src={source} dst={destination} "
+                     f"dump={':'.join(hex_digits(2) for _ in range(40))}")
+        expected.extend((source, destination))
+    text = '\n'.join(lines)
+
+    matches = ipv6.parse(text)
+    assert [match_text for match_text, _, _ in matches] == expected
+    assert all(text[start:end] == match_text for match_text, start, end in matches)
+
+
+def test_separators_around_an_address_are_not_part_of_it():
+    assert ipv6.parse("ip:2001:db8::1, end of 2001:db8::2.") == [('2001:db8::1', 3, 14), ('2001:db8::2', 23, 34)]
+
+
+def test_identifiers_are_not_addresses():
+    assert ipv6.parse("var_2001:db8::1 2001:db8::1x") == []
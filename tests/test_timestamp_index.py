@@ -0,0 +1,45 @@
+from datetime import datetime
+from logline_leviathan.file_processor.line_index import LineIndex
+from logline_leviathan.file_processor.timestamp_index import TimestampIndex
+
+
+def build_index(content, timestamp_format=None):
+    return TimestampIndex(content, LineIndex(content), timestamp_format)
+
+
+def test_lines_in_another_format_keep_their_own_timestamp():
+    # The European lines are the minority; they must not inherit the timestamp of the ISO line above them
+    content = ''.join(f"2024-01-{day:02d} 10:00:00 iso entry\n"
+                      f"2024-01-{day:02d} 10:30:00 iso entry\n"
+                      f"{day:02d}/02/2023 11:00:00 european entry\n"
+                      f"continuation without a timestamp\n" for day in range(1, 18))
+    index = build_index(content)
+    assert index.timestamp_format.date_format == '%Y-%m-%d %H:%M:%S'
+    for day in range(1, 18):
+        first_line = (day - 1) * 4
+        assert index.timestamp_for_line(first_line) == datetime(2024, 1, day, 10, 0)
+        assert index.timestamp_for_line(first_line + 1) == datetime(2024, 1, day, 10, 30)
+        assert index.timestamp_for_line(first_line + 2) == datetime(2023, 2, day, 11, 0)
+        assert index.timestamp_for_line(first_line + 3) == datetime(2023, 2, day, 11, 0)
+
+
+def test_minority_format_with_a_given_dominant_format():
+    content = "2024-03-01 08:00:00 first\n05.04.2022 09:15:00 second\nthird\n"
+    dominant_format = build_index(content).timestamp_format
+    index = build_index(content, dominant_format)
+    assert index.timestamp_for_line(0) == datetime(2024, 3, 1, 8, 0)
+    assert index.timestamp_for_line(1) == datetime(2022, 4, 5, 9, 15)
+    assert index.timestamp_for_line(2) == datetime(2022, 4, 5, 9, 15)
+
+
+def test_dominant_format_wins_on_a_line_with_two_formats():
+    content = "2024-03-01 08:00:00 a\n2024-03-02 08:00:00 seen 01/01/2020 00:00:00\n"
+    index = build_index(content)
+    assert index.timestamp_for_line(1) == datetime(2024, 3, 2, 8, 0)
+
+
+def test_lines_before_the_first_timestamp_have_none():
+    content = "header\n2024-03-01 08:00:00 a\n"
+    index = build_index(content)
+    assert index.timestamp_for_line(0) is None
+    assert index.timestamp_for_line(1) == datetime(2024, 3, 1, 8, 0)